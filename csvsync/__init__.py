@@ -4,6 +4,10 @@ import csvsync.config
 import csvsync.gsheet
 import csvsync.state
 import csvsync.lib
+import csvsync.api
 import csvsync.cli
 import csvsync.cli_sync
 import csvsync.cli_pull
+import csvsync.cli_history
+import csvsync.cli_conflicts
+import csvsync.cli_plan
@@ -0,0 +1,71 @@
+# Asyncio support for overlapping network I/O with local work.
+#
+# The google API client is synchronous, so every blocking call is run
+# in a worker thread and awaited from the event loop.  The httplib2
+# transport underneath the client is not thread-safe; gsheet.Sheet
+# therefore gives each worker thread its own authorised http object
+# (see Sheet.execute).
+
+import asyncio
+import logging
+import concurrent.futures
+
+def complete(coro):
+    """
+    Run a coroutine to completion from synchronous code.  asyncio.run()
+    can't be used from a thread which already has a running event loop
+    (e.g. when csvsync is embedded in an asyncio application), so in
+    that case the coroutine gets its own loop in a separate thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+async def run(func, *args, **kwargs):
+    """Run a blocking function in a worker thread"""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+async def gather_limited(awaitables, limit):
+    """
+    Await all of the given awaitables concurrently, with at most
+    `limit` in flight at once.  Results are returned in order.
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def limited(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*[limited(awaitable) for awaitable in awaitables])
+
+async def retry(func, *args, retries = 0):
+    """Run a blocking function in a worker thread, retrying on failure"""
+    for attempt in range(retries + 1):
+        try:
+            return await run(func, *args)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logging.debug(f"Attempt {attempt + 1} of {func.__name__} failed "
+                          f"({e!r}), retrying")
+
+class AsyncSheet:
+    """Asyncio wrapper around the gsheet.Sheet operations used by csvsync"""
+
+    def __init__(self, sheet):
+        self.sheet = sheet
+
+    async def batch_update(self, body, retries = 0):
+        # A body may also be given as a function building it, so that
+        # large bodies are only built once it is their turn to be sent
+        if callable(body):
+            body = await run(body)
+        return await retry(self.sheet.batch_update, body, retries = retries)
+
+    async def batch_update_all(self, bodies, limit, retries = 0):
+        return await gather_limited([self.batch_update(body, retries) for body in bodies],
+                                    limit)
@@ -0,0 +1,550 @@
+# Python API for embedding csvsync.
+#
+# Runs sync, pull and push operations in-process, returning a
+# SyncResult describing what happened and raising SyncError (or
+# another CLIError) on failure rather than exiting.  The csvsync CLI
+# commands are thin wrappers around these functions.
+#
+# Typical use from a long-running scheduler:
+#
+#     config = csvsync.config.Config()
+#     for result in csvsync.api.sync_many(config, names, concurrency = 8):
+#         ...
+#
+# From within an asyncio application, await async_sync_many() instead.
+
+from . import aio, partition, backend, conflicts, plan as planner
+from .config import Config
+from .state import Sync
+from .lib import *
+
+import os
+import time
+import filecmp
+import logging
+
+import csvdiff3
+
+class LocalChangesError(SyncError):
+    """Raised when a pull would overwrite local changes"""
+
+class SyncResult:
+    """Outcome of a single sync, pull or push operation"""
+
+    def __init__(self, name, command, local_filename = None):
+        self.name = name
+        self.command = command
+        self.local_filename = local_filename
+
+        # Final sync state of the file, eg. READY, or RESOLVE if the
+        # merge stopped for manual conflict resolution
+        self.state = None
+        self.conflicts = False
+
+        # Whether anything was uploaded, and the row changes (a
+        # diff.Changes) sent to the remote when the replica knows them
+        self.uploaded = False
+        self.rows_changed = None
+
+        # Local backup taken before the local file was overwritten
+        self.backup_filename = None
+
+        # Exception raised, when run through sync_many
+        self.error = None
+
+        # Elapsed seconds for each phase of the operation
+        self.timings = {}
+
+    def __repr__(self):
+        return f"<SyncResult {self.name} {self.command}: {self.state}" + \
+            (" (conflicts)" if self.conflicts else "") + \
+            (f" error={self.error!r}" if self.error else "") + ">"
+
+class Timer:
+    """Context manager recording the time taken by a phase in a SyncResult"""
+
+    def __init__(self, result, phase):
+        self.result = result
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *args):
+        self.result.timings[self.phase] = time.monotonic() - self.start
+
+def get_sync(config, name):
+    if config is None:
+        config = Config()
+
+    try:
+        fileconfig = config[name]
+    except KeyError:
+        raise SyncError(f"Cannot find config matching filename: {name}")
+
+    return Sync(fileconfig)
+
+def check_state(sync, expected = "READY"):
+    status = sync.status
+    if status != expected:
+        raise SyncError(f"File {sync.fileconfig.section_name} not {expected} (state is {status})")
+
+##
+## sync
+##
+
+def sync(config, name, continue_sync = False):
+    """Run (or, with continue_sync, finish) a 3-way sync of one file"""
+
+    sync = get_sync(config, name)
+    result = SyncResult(sync.fileconfig.section_name, "sync", sync.local_filename)
+
+    with sync.locked():
+        if continue_sync:
+            check_resolved(sync)
+            merge_complete(sync, result)
+        else:
+            run_sync(sync, result)
+
+    result.state = sync.status
+    return result
+
+def run_sync(sync, result):
+    # Test things look OK before we start downloading data.  The
+    # initial setup of the Sync class will have done basic validation
+    # of the config, but now we need to test that the various files we
+    # need are actually present etc.
+
+    # Make sure we have a latest-common-ancestor to work with
+
+    if not os.path.exists(sync.ancestor_filename):
+        raise SyncError(f"No saved copy ({sync.ancestor_filename}) exists for file")
+
+    # Make sure we're not already in the middle of a sync
+    # (eg. manually resolving a sync with conflicts)
+
+    check_state(sync)
+
+    sync.state_change("READY", "PULL", command = "sync")
+
+    # Until the merge result is copied over the local file, neither
+    # the local file nor the remote has changed, so on any failure up
+    # to then we can simply go back to READY and try again later.
+
+    try:
+        # Prepare files for merge:
+        # Download the remote file, and take a copy of the local file
+
+        with Timer(result, "prepare"):
+            sync.prepare_merge()
+
+        sync.state_change("PULL", "MERGE")
+
+        # Create a 3-way merge
+        with Timer(result, "merge"):
+            merged = merge_files(sync)
+    except:
+        sync.restore_ready()
+        raise
+
+    sync.state_change("MERGE", "RESOLVE")
+
+    sync.copy_file("merge", "local")
+
+    if not merged:
+        logging.debug("Conflicts found in merge")
+        result.conflicts = True
+
+        index = sync.conflict_index
+        index.save(index.build(sync.ancestor_filename, sync.local_copy_filename,
+                               sync.download_filename, sync.fileconfig['key'],
+                               sync.merge_filename))
+        return
+
+    logging.debug("No conflicts found in merge")
+    merge_complete(sync, result)
+
+def merge_files(sync):
+    # Locate the 3 files for a 3-way merge:
+    #
+    # LCA (Latest Common Ancestor) is the local SAVE file
+
+    filename_LCA = sync.ancestor_filename
+
+    # Branch A is the csvsync copy of the local working file
+
+    filename_A = sync.local_copy_filename
+
+    # Branch B is the downloaded copy of the remote google sheet
+
+    filename_B = sync.download_filename
+
+    # And our output is going to be the local MERGE file
+
+    filename_output = sync.merge_filename
+
+    if sync.local_unchanged:
+        logging.debug("No local changes, merge result is the download")
+        sync.copy_file("download", "merge")
+        return True
+
+    # Large tables can be merged partition by partition
+    if sync.fileconfig.section.getint('partition_rows') > 0:
+        eprint("Merging changed partitions...")
+        sync.partition_plan = partition.merge(sync)
+        if sync.partition_plan:
+            return True
+
+    # We need to lookup the right primary key for the merge
+
+    merge_key = sync.fileconfig['key']
+    quote = sync.fileconfig['quote']
+    lineterminator = sync.fileconfig['lineterminator']
+
+    eprint("Merging files...")
+    logging.debug("Running 3-way merge: "
+                  f"{filename_LCA}, {filename_A}, {filename_B} -> {filename_output}")
+    with open(filename_LCA, 'rt') as file_LCA:
+        with open(filename_A, 'rt') as file_A:
+            with open(filename_B, 'rt') as file_B:
+                with open(filename_output, 'wt') as file_output:
+                    result = csvdiff3.merge3.merge3(file_LCA, file_A, file_B,
+                                                    merge_key,
+                                                    quote = quote,
+                                                    lineterminator = lineterminator,
+                                                    output = file_output)
+
+    logging.debug(f"Merge completed with result {result}")
+    # We return True (success) if the merge did NOT have a conflict
+    return not result
+
+def check_resolved(sync):
+    # If we stopped for conflicts, make sure they have all been
+    # resolved before going any further.
+
+    if sync.status != "RESOLVE":
+        return
+
+    index = sync.conflict_index
+    if index.exists():
+        unresolved = index.unresolved()
+        if unresolved:
+            raise SyncError(f"{len(unresolved)} conflicts still unresolved in "
+                            f"{sync.local_filename} (keys: {', '.join(unresolved[:10])})")
+
+    # The index may be missing, and only checks the regions it knows
+    # about while the file is unchanged, so always scan for markers too
+    if conflicts.has_markers(sync.local_filename):
+        raise SyncError(f"Conflict markers remain in {sync.local_filename}")
+
+def merge_complete(sync, result):
+    sync.conflict_index.remove()
+
+    sync.state_change("RESOLVE", "PUSH")
+
+    # The 3-way merge has been completed (either automatically, or
+    # after manual conflict resolution).
+    #
+    # We can now save it as a SAVE file as LCA for the next 3-way
+    # merge, and upload the results.
+
+    sync.copy_file("local", "ancestor")
+
+    # If the download file still exists (ie. we didn't pause for a
+    # manual conflict resolution), and the reconciled file is the
+    # same as the download, then we don't need to re-upload.
+
+    plan = sync.partition_plan
+
+    if os.path.exists(sync.download_filename) and \
+       filecmp.cmp(sync.download_filename, sync.ancestor_filename,
+                   shallow = False):
+        eprint('No changes pending against remote file, skipping re-upload')
+        sync.save_ancestor()
+        sync.keep_remote_version()
+    elif plan and os.path.exists(sync.download_filename):
+        # A partitioned merge knows exactly which lines changed
+        if sync.replica and sync.replica.exists("remote"):
+            result.rows_changed = sync.replica.diff_file("remote", sync.ancestor_filename)
+        sync.save_ancestor()
+        with Timer(result, "upload"):
+            sync.upload_partitions(plan)
+        result.uploaded = True
+    else:
+        if sync.replica and sync.replica.exists("remote"):
+            result.rows_changed = sync.replica.diff_file("remote", sync.ancestor_filename)
+        sync.save_ancestor()
+        with Timer(result, "upload"):
+            sync.upload()
+        result.uploaded = True
+
+    if plan:
+        partition.record(sync, plan)
+
+    sync.state_change("PUSH", "READY", command = "none")
+    sync.cleanup()
+
+##
+## pull
+##
+
+def pull(config, name, force = False):
+    """
+    Replace the local file with the remote sheet.  Local changes
+    since the last sync are only overwritten if force is set.
+    """
+
+    sync = get_sync(config, name)
+    result = SyncResult(sync.fileconfig.section_name, "pull", sync.local_filename)
+
+    with sync.locked():
+        run_pull(sync, result, force)
+
+    result.state = sync.status
+    return result
+
+def run_pull(sync, result, force):
+    # Check we don't already have a command in progress
+    check_state(sync)
+
+    # Check if we would be overwriting any important local files
+
+    check_already_exists(sync, result, force)
+
+    sync.state_change("READY", "PULL", command = "pull")
+
+    # A failed download leaves everything as it was
+    try:
+        with Timer(result, "download"):
+            sync.download()
+    except:
+        sync.restore_ready()
+        raise
+
+    # The downloaded file becomes both the local file and the most
+    # recent ancestor.
+
+    os.rename(sync.download_filename, sync.ancestor_filename)
+    sync.copy_file("ancestor", "local")
+    sync.save_ancestor()
+    sync.keep_remote_version()
+
+    sync.state_change("PULL", "READY", command = "none")
+
+def check_already_exists(sync, result, force):
+
+    # If the file does not exist locally already, then the pull is fine.
+
+    if not os.path.exists(sync.local_filename):
+        logging.debug("PULL: no local file to overwrite, pull is OK")
+        return
+
+    # If it exists, we need to see if it has any local modifications
+    # (ie. is different from the LCA if present.)
+
+    if os.path.exists(sync.ancestor_filename):
+        if filecmp.cmp(sync.local_filename, sync.ancestor_filename):
+
+            # They are the same: we'll save a backup of the local file
+            # and allow the pull
+
+            logging.debug("PULL: local file exists but no local changes to overwrite, "
+                          "pull is OK")
+            do_pull_backup(sync, result)
+            return
+
+        else:
+
+            # Local changes would be overwritten: don't allow the pull
+            # unless the user uses --force
+
+            if force:
+
+                logging.debug("PULL: local file changes exist, overwrite forced")
+                do_pull_backup(sync, result)
+
+            else:
+
+                logging.debug("PULL: local file exists and has local changes, pull denied")
+                raise LocalChangesError(f"Pull would overwrite changes to file {sync.local_filename}")
+
+def do_pull_backup(sync, result):
+    sync.copy_file("local", "local_copy")
+    result.backup_filename = sync.local_copy_filename
+    logging.debug(f"PULL: Backup stored in {sync.local_copy_filename}")
+
+##
+## push
+##
+
+def push(config, name):
+    """
+    Upload the local file to the remote sheet.
+
+    The remote's version stamp and revision are checked first: if they
+    still match the ones recorded at the last sync, nobody else has
+    uploaded or edited the remote since, and the local file can be
+    pushed straight away.  Otherwise (or if the backend has no way of
+    telling) we fall back to a full sync, merging in the remote
+    changes.
+    """
+
+    sync = get_sync(config, name)
+    result = SyncResult(sync.fileconfig.section_name, "push", sync.local_filename)
+
+    with sync.locked():
+        run_push(sync, result)
+
+    result.state = sync.status
+    return result
+
+def run_push(sync, result):
+    check_state(sync)
+
+    if not os.path.exists(sync.local_filename):
+        raise SyncError(f"Local file ({sync.local_filename}) not found")
+
+    with Timer(result, "check"):
+        unchanged = sync.remote_unchanged()
+
+    if not unchanged:
+        eprint("Remote has changed since the last sync, running a full sync")
+        result.command = "sync"
+        return run_sync(sync, result)
+
+    if os.path.exists(sync.ancestor_filename) and \
+       filecmp.cmp(sync.local_filename, sync.ancestor_filename, shallow = False):
+        eprint("No local changes to push")
+        return
+
+    sync.state_change("READY", "PUSH", command = "push")
+
+    # The local file becomes the new latest common ancestor
+    sync.copy_file("local", "ancestor")
+    if sync.replica and sync.replica.exists("remote"):
+        result.rows_changed = sync.replica.diff_file("remote", sync.ancestor_filename)
+    sync.save_ancestor()
+
+    with Timer(result, "upload"):
+        sync.upload()
+    result.uploaded = True
+
+    sync.state_change("PUSH", "READY", command = "none")
+
+##
+## plan
+##
+
+def plan(config, name, cached = False):
+    """
+    Work out what a sync of one file would do and cost, without
+    changing anything.  Returns a plan.Plan.
+    """
+
+    sync = get_sync(config, name)
+    return planner.make_plan(sync, cached = cached)
+
+##
+## Batch operation
+##
+
+def sync_many(config, names, concurrency = 4, command = sync, **kwargs):
+    """
+    Run a command (sync by default) over many files in this process,
+    with up to `concurrency` files in progress at once.
+
+    Errors don't stop the batch: each file's exception is recorded in
+    the error attribute of its SyncResult.  Results are returned in
+    the same order as names.
+    """
+
+    return run_batch(config, [(command, name) for name in names], concurrency, **kwargs)
+
+async def async_sync_many(config, names, concurrency = 4, command = sync, **kwargs):
+    """
+    As sync_many, for use from a running event loop.  Each file is
+    still synced in a worker thread.
+    """
+
+    return await async_run_batch(config, [(command, name) for name in names],
+                                 concurrency, **kwargs)
+
+def run_batch(config, jobs, concurrency = 4, **kwargs):
+    # Run a list of (command, name) jobs concurrently
+    return aio.complete(async_run_batch(config, jobs, concurrency, **kwargs))
+
+async def async_run_batch(config, jobs, concurrency = 4, **kwargs):
+    if config is None:
+        config = Config()
+
+    def run_one(command, name):
+        try:
+            return command(config, name, **kwargs)
+        except Exception as e:
+            logging.debug(f"Batch {command.__name__} of {name} failed: {e!r}")
+            result = SyncResult(name, command.__name__)
+            result.error = e
+            return result
+
+    return await aio.gather_limited([aio.run(run_one, command, name) for command, name in jobs],
+                                    concurrency)
+
+def sync_changed(config, concurrency = 4):
+    """
+    Sync every configured file that needs it, using one poll of each
+    backend's changes feed (for Google Sheets, the Drive changes feed)
+    to find the spreadsheets changed remotely.
+
+    Files whose spreadsheet changed get a full sync.  Other files
+    with local changes are pushed, which needs only a version stamp
+    and revision check rather than a download.  Everything else is skipped.
+    """
+
+    if config is None:
+        config = Config()
+
+    fileconfigs = list(config.file_configs())
+    if not fileconfigs:
+        return []
+
+    # One feed per backend in use.  A backend without a feed can't
+    # tell us what changed, so all of its files are synced.
+    feeds = {}
+    for fileconfig in fileconfigs:
+        name = fileconfig['backend']
+        if name not in feeds:
+            feed = backend.backend_class(name).changes_feed(config, fileconfig)
+            feeds[name] = (feed, *(feed.poll() if feed else (None, None)))
+
+    jobs = []
+    spreadsheets = {}
+    for fileconfig in fileconfigs:
+        name = fileconfig.section_name
+        feed, changed, token = feeds[fileconfig['backend']]
+        remote_id = backend.backend_class(fileconfig['backend']).remote_id(fileconfig)
+        spreadsheets[name] = (fileconfig['backend'], remote_id)
+
+        if changed is None or remote_id in changed:
+            jobs.append((sync, name))
+        elif local_changed(config, name):
+            jobs.append((push, name))
+        else:
+            logging.debug(f"No changes to {name}, skipping")
+
+    results = run_batch(config, jobs, concurrency)
+
+    # Spreadsheets whose sync failed are retried next time
+    failed = set([spreadsheets[result.name] for result in results if result.error])
+    for name, (feed, changed, token) in feeds.items():
+        if feed:
+            feed.commit(token, set([remote_id for kind, remote_id in failed if kind == name]))
+
+    return results
+
+def local_changed(config, name):
+    sync = get_sync(config, name)
+    if not os.path.exists(sync.local_filename):
+        return False
+    if not os.path.exists(sync.ancestor_filename):
+        return True
+    return not filecmp.cmp(sync.local_filename, sync.ancestor_filename, shallow = False)
@@ -0,0 +1,105 @@
+# Pluggable remote backends.
+#
+# The remote copy of each synced file lives in a backend, selected by
+# the "backend" key of its file config.  Sync only ever talks to the
+# remote through the Backend interface below, so the whole sync state
+# machine runs unchanged against any backend.
+#
+#   gsheet: a Google Sheets tab (gsheet.Sheet), the default
+#   local:  a tab in a SQLite file in a local directory
+#           (localsheet.LocalSheet), for load testing, staging mirrors
+#           and benchmarks at local disk speed
+#
+# Other remote stores can be added by registering them in BACKENDS.
+
+from .lib import CLIError
+
+import importlib
+
+# Backend name -> (module, class)
+BACKENDS = {
+    'gsheet': ('gsheet', 'Sheet'),
+    'local': ('localsheet', 'LocalSheet'),
+}
+
+def backend_class(name):
+    try:
+        module, classname = BACKENDS[name]
+    except KeyError:
+        raise CLIError(f'Unknown backend "{name}" '
+                       f'(expected one of {", ".join(sorted(BACKENDS))})')
+    # Backends are only imported when used.  The local backend
+    # (localsheet, built on grid) imports nothing from the Google API
+    # client itself, although the csvsync package as a whole still
+    # loads gsheet.
+    return getattr(importlib.import_module('.' + module, __package__), classname)
+
+def open_backend(fileconfig):
+    return backend_class(fileconfig['backend']).open(fileconfig)
+
+class Backend:
+    """
+    Remote copy of a synced table.
+
+    Every backend holds a single table ("tab") and knows how to
+    download it to a CSV file and upload it from one, carrying the
+    version stamp of the last csvsync upload along with it.
+    """
+
+    # Number of rows the remote table has room for, from its metadata
+    row_count = 0
+
+    @classmethod
+    def open(cls, fileconfig):
+        """Connect to the remote table described by a file config"""
+        return cls(fileconfig)
+
+    @classmethod
+    def remote_id(cls, fileconfig):
+        """The identifier a change probe reports for this file"""
+        return fileconfig['spreadsheet_id']
+
+    @classmethod
+    def changes_feed(cls, config, fileconfig):
+        """
+        Return a feed of remote changes, with the same poll() and
+        commit() methods as changes.ChangesFeed, or None if the backend
+        can't tell which tables changed (so they all must be synced).
+        """
+        return None
+
+    def save_to_csv(self, filename, pad_lines = True, base_filename = None):
+        """
+        Download the table to a CSV file.  base_filename, if given,
+        holds the contents as of the last sync, which the backend may
+        use to avoid downloading unchanged rows.
+        """
+        raise NotImplementedError
+
+    def load_from_csv(self, filename, version = None):
+        """
+        Replace the table with the contents of a CSV file, setting the
+        version stamp once the data is in place
+        """
+        raise NotImplementedError
+
+    def load_windows(self, windows, total_rows, clear_from = None, retries = 0,
+                     version = None):
+        """
+        Replace just some windows of rows, given as (first row, rows)
+        pairs, clearing lines from total_rows up to clear_from
+        """
+        raise NotImplementedError
+
+    def read_version(self):
+        """The version stamp of the last csvsync upload, or None"""
+        raise NotImplementedError
+
+    def read_revision(self):
+        """
+        An identifier of the table's current contents, which changes
+        with every edit, by csvsync or anyone else, or None if the
+        backend can't tell.  A push without a merge needs this to be
+        unchanged since the last sync, as well as the version stamp.
+        """
+        return None
@@ -0,0 +1,93 @@
+# Fleet-wide remote change detection using the Drive changes feed.
+#
+# Rather than probing every synced sheet for changes, we keep a Drive
+# changes page token in the top-level syncdir and ask Drive once per
+# run which files have changed since then.  Only the files whose
+# spreadsheet appears in that list need downloading and merging.
+#
+# The token state also remembers spreadsheets whose sync failed, so
+# that they are retried on the next run even though Drive will not
+# report them again.
+#
+# The Google API client is only imported once the Drive service is
+# needed, as feeds for other backends (eg. localsheet) build on this.
+
+from .lib import atomic_write
+
+import os
+import json
+import logging
+
+class ChangesFeed:
+    # Name of the page token state file in the syncdir
+    STATE_NAME = 'CHANGES'
+
+    def __init__(self, config, fileconfig):
+        # fileconfig supplies the credentials to use
+        self.fileconfig = fileconfig
+        syncdir = config.file_relative_to_config(config.config['DEFAULT']['syncdir'])
+        self.filename = os.path.join(syncdir, self.STATE_NAME)
+        self.__service = None
+
+    @property
+    def service(self):
+        if not self.__service:
+            from googleapiclient.discovery import build
+            from . import gsheet
+
+            auth = gsheet.Auth(self.fileconfig, 'drive_token', gsheet.DRIVE_SCOPES)
+            self.__service = build('drive', 'v3', credentials = auth.creds,
+                                   cache_discovery = False)
+        return self.__service
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return {'token': None, 'pending': []}
+        with open(self.filename, 'rt') as file:
+            return json.load(file)
+
+    def save(self, token, pending):
+        os.makedirs(os.path.dirname(self.filename), exist_ok = True)
+        atomic_write(self.filename, json.dumps({'token': token, 'pending': sorted(pending)}),
+                     mode = 'wt')
+
+    def poll(self):
+        """
+        Return (changed, token): the set of file IDs changed since the
+        last commit (or None if we have no starting point yet, meaning
+        everything must be treated as changed), and the page token to
+        commit once those changes have been dealt with.
+        """
+        state = self.load()
+        token = state['token']
+
+        if not token:
+            token = self.service.changes() \
+                .getStartPageToken(supportsAllDrives = True) \
+                .execute()['startPageToken']
+            logging.debug(f"CHANGES: no saved page token, starting from {token}")
+            return None, token
+
+        changed = set(state['pending'])
+        calls = 0
+        while True:
+            response = self.service.changes() \
+                .list(pageToken = token, pageSize = 1000,
+                      includeItemsFromAllDrives = True, supportsAllDrives = True,
+                      fields = 'nextPageToken,newStartPageToken,changes(fileId)') \
+                .execute()
+            calls += 1
+
+            changed.update([change['fileId'] for change in response.get('changes', [])])
+
+            if 'newStartPageToken' in response:
+                token = response['newStartPageToken']
+                break
+            token = response['nextPageToken']
+
+        logging.debug(f"CHANGES: {len(changed)} files changed ({calls} changes.list calls)")
+        return changed, token
+
+    def commit(self, token, failed):
+        # Record the new page token, and the spreadsheets to retry
+        self.save(token, failed)
@@ -1,6 +1,6 @@
 # Main CLI handling for the csvsync command.
 
-from . import config, gsheet, state, lib
+from . import config, gsheet, state, lib, diff, api
 from .config import Config
 from .state import Sync
 from .lib import *
@@ -8,8 +8,8 @@ from .lib import *
 import click
 import sys
 import os
-import shutil
 import logging
+import time
 
 @click.group()
 @click.option("-d", "--debug", is_flag = True, default = False)
@@ -28,9 +28,18 @@ def cli_push(filename):
     config = Config()
     fileconfig = find_config(config, filename)
 
-    sync = Sync(fileconfig)
-
-    sync.cli_push()
+    # A push falls back to a full sync if the remote has changed,
+    # which may stop on conflicts just as "csvsync sync" does
+    result = api.push(config, fileconfig.section_name)
+    exit_on_conflicts(result, fileconfig)
+
+def exit_on_conflicts(result, fileconfig):
+    if result.conflicts:
+        eprint(f"Warning: merge conflicts in {result.local_filename}\n"
+               f"Fix conflicts (see csvsync conflicts {fileconfig.section_name}) "
+               f"then continue with\n"
+               f"  $ csvsync sync --continue {fileconfig.section_name}")
+        exit(1)
 
 @csvsync_cli.command("abort")
 @click.argument("filename")
@@ -41,26 +50,40 @@ def cli_abort(filename):
 
     sync = Sync(fileconfig)
 
-    status = sync.status
+    with sync.locked():
+        status = sync.status
 
-    if status != 'RESOLVE':
-        raise CLIError(f'no sync in progress (status is {status})')
-        exit(1)
+        # PULL and MERGE are only left behind by a process which was
+        # killed part way through a sync
+        if status not in ('RESOLVE', 'PULL', 'MERGE'):
+            raise CLIError(f'no sync in progress (status is {status})')
+            exit(1)
 
-    if os.path.exists(sync.download_filename):
-        os.unlink(sync.download_filename)
+        if os.path.exists(sync.download_filename):
+            os.unlink(sync.download_filename)
 
-    if os.path.exists(sync.merge_filename):
-        os.unlink(sync.merge_filename)
+        if os.path.exists(sync.merge_filename):
+            os.unlink(sync.merge_filename)
 
-    sync.status = 'READY'
+        sync.conflict_index.remove()
+
+        sync.status = 'READY'
 
 
 @csvsync_cli.command("status")
-@click.argument("filename")
+@click.option("-v", "--verbose", is_flag = True, default = False)
+@click.option("-a", "--all", "all_files", is_flag = True, default = False,
+              help = "Show the status of every configured file")
+@click.argument("filename", required = False)
 
-def cli_status(filename):
+def cli_status(filename, verbose, all_files):
     config = Config()
+
+    if all_files:
+        return status_all(config)
+    if filename is None:
+        raise CLIError("Give a filename, or --all")
+
     fileconfig = find_config(config, filename)
 
     sync = Sync(fileconfig)
@@ -69,17 +92,79 @@ def cli_status(filename):
 
     print(status)
 
+    # Verbose status reports pending local changes from the replica,
+    # without needing to contact the remote sheet
+    if verbose:
+        print(f"Local changes: {sync.local_changes().summary()}")
+
     # Status will also dump additional file stats to the DEBUG log, if enabled:
     logging.debug("File info:")
     for attr, desc in [("local_filename", "Local file"),
-                       ("status_filename", "status"),
+                       ("state_filename", "state database"),
                        ("download_filename", "download"),
                        ("merge_filename", "merge"),
+                       ("replica_filename", "replica"),
                        ("ancestor_filename", "saved ancestor")]:
         filename = getattr(sync, attr)
         present = "(Present)" if os.path.exists(filename) else "(Not present)"
         logging.debug("  %s: %s %s" % (desc, filename, present))
 
+@csvsync_cli.command("diff")
+@click.argument("filename")
+
+def cli_diff(filename):
+    config = Config()
+    fileconfig = find_config(config, filename)
+
+    sync = Sync(fileconfig)
+
+    # Show pending local changes against the latest common ancestor
+    # held in the replica.  This needs no network access.
+
+    changes = sync.local_changes()
+
+    header, rows = diff.read_rows(sync.local_filename)
+    index = diff.key_index(header, fileconfig['key'])
+    local_rows = {diff.row_key(row, index): n for n, row in enumerate(rows)}
+    base_rows = sync.replica.rows_for_keys("base", changes.removed + changes.changed)
+
+    for key in changes.removed:
+        print(f"- {key}")
+    for key in changes.added:
+        print(f"+ {key}")
+    for key in changes.changed:
+        print(f"~ {key}")
+        old, new = base_rows[key], rows[local_rows[key]]
+        for column in range(max(len(old), len(new))):
+            old_cell = old[column] if column < len(old) else ''
+            new_cell = new[column] if column < len(new) else ''
+            if old_cell != new_cell:
+                name = header[column] if column < len(header) else str(column + 1)
+                print(f"    {name}: {old_cell!r} -> {new_cell!r}")
+
+    if not changes:
+        eprint("No local changes")
+
+def status_all(config):
+    # Answer from each syncdir's state database in a single query,
+    # rather than loading the state of each file in turn
+
+    syncs = [Sync(fileconfig) for fileconfig in config.file_configs()]
+    databases = {}
+    for sync in syncs:
+        if sync.state_filename not in databases:
+            databases[sync.state_filename] = sync.statedb.all()
+
+    for sync in syncs:
+        status, command, updated = databases[sync.state_filename].get(
+            sync.basename, ("NEW", "none", None))
+        line = f"{sync.fileconfig.section_name}: {status}"
+        if command != "none":
+            line += f" ({command})"
+        if updated is not None:
+            line += time.strftime(" since %Y-%m-%d %H:%M:%S", time.localtime(updated))
+        print(line)
+
 ##
 ## General support code for CLI handlers
 ##
@@ -0,0 +1,73 @@
+import click
+import csvsync
+import logging
+
+from csvsync.cli import csvsync_cli
+from csvsync.config import Config
+from csvsync.state import Sync
+from csvsync.lib import *
+
+@csvsync_cli.command("conflicts")
+@click.argument("filename")
+@click.option("-k", "--key", "keys", multiple = True,
+              help = "Key of a conflict to resolve (may be repeated)")
+@click.option("-t", "--take", type = click.Choice(["local", "remote"]), default = None,
+              help = "Resolve by taking the local or remote row")
+@click.option("-s", "--set", "settings", multiple = True, metavar = "COLUMN=VALUE",
+              help = "Resolve by setting a column value (may be repeated)")
+
+def cli_conflicts(filename, keys, take, settings):
+    config = Config()
+    fileconfig = csvsync.cli.find_config(config, filename)
+
+    sync = Sync(fileconfig)
+
+    # With no keys given we just list the outstanding conflicts
+
+    if not keys:
+        if take or settings:
+            raise CLIError("No conflict keys given to resolve")
+        list_conflicts(sync)
+        return
+
+    if not take and not settings:
+        raise CLIError("Use --take and/or --set to resolve conflicts")
+
+    values = {}
+    for setting in settings:
+        column, sep, value = setting.partition("=")
+        if not sep:
+            raise CLIError(f'Invalid setting "{setting}", expecting COLUMN=VALUE')
+        values[column] = value
+
+    with sync.locked():
+        csvsync.cli.cli_check_state(sync, "RESOLVE")
+        sync.conflict_index.resolve(keys, take or "local", values,
+                                    fileconfig.csv_options())
+        logging.debug(f"CONFLICTS: resolved keys {', '.join(keys)}")
+
+def list_conflicts(sync):
+    index = sync.conflict_index.load()
+
+    for conflict in index['conflicts']:
+        state = "resolved" if conflict['resolved'] else "unresolved"
+        if csvsync.conflicts.located(conflict):
+            print(f"{conflict['key']}  (line {conflict['line']}, "
+                  f"bytes {conflict['start']}-{conflict['end']}, {state})")
+        else:
+            print(f"{conflict['key']}  (not located in merge output, {state})")
+
+        if conflict['resolved']:
+            continue
+
+        if conflict['local'] is None or conflict['remote'] is None:
+            deleted = "local" if conflict['local'] is None else "remote"
+            print(f"    deleted on {deleted} side, changed on the other")
+            continue
+
+        header = index['header']
+        for column in conflict['columns']:
+            n = header.index(column)
+            local, remote = (row[n] if n < len(row) else ''
+                             for row in (conflict['local'], conflict['remote']))
+            print(f"    {column}: local {local!r}, remote {remote!r}")
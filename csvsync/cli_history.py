@@ -0,0 +1,69 @@
+import click
+import csvsync
+import os
+import logging
+
+from csvsync.cli import csvsync_cli
+from csvsync.config import Config
+from csvsync.state import Sync
+from csvsync.lib import *
+
+@csvsync_cli.command("history")
+@click.option("--gc", is_flag = True, default = False,
+              help = "Remove stored objects no longer used by any snapshot in the syncdir")
+@click.argument("filename")
+
+def cli_history(filename, gc):
+    config = Config()
+    fileconfig = csvsync.cli.find_config(config, filename)
+
+    sync = Sync(fileconfig)
+    history = get_history(sync)
+
+    if gc:
+        removed = history.gc()
+        eprint(format_cli_info(f"Removed {removed} unused history objects"))
+        return
+
+    for entry in history.entries():
+        print(f"{entry['id']:5d}  {entry['time']}  {entry['kind']:9s}  "
+              f"{entry['size']:12d}  {entry['sha256'][:12]}")
+
+@csvsync_cli.command("restore")
+@click.argument("filename")
+@click.argument("snapshot", type = int)
+@click.option("-o", "--output", default = None,
+              help = "Write the snapshot here instead of over the local file")
+
+def cli_restore(filename, snapshot, output):
+    config = Config()
+    fileconfig = csvsync.cli.find_config(config, filename)
+
+    sync = Sync(fileconfig)
+    history = get_history(sync)
+
+    if output:
+        history.restore(snapshot, output)
+        eprint(format_cli_info(f"Snapshot {snapshot} written to {output}"))
+        return
+
+    # Restoring over the local file is just a local edit, which the
+    # next sync will merge and push as normal.  Don't do it in the
+    # middle of a sync, and keep a backup of the current contents.
+
+    with sync.locked():
+        csvsync.cli.cli_check_state(sync)
+
+        if os.path.exists(sync.local_filename):
+            sync.copy_file("local", "local_copy")
+            eprint(format_cli_info(f"Storing backup in {sync.local_copy_filename}"))
+
+        entry = history.restore(snapshot, sync.local_filename)
+        logging.debug(f"RESTORE: snapshot {snapshot} ({entry['kind']}) "
+                      f"restored to {sync.local_filename}")
+
+def get_history(sync):
+    history = sync.history
+    if not history:
+        raise CLIError(f"History is disabled for file {sync.fileconfig.section_name}")
+    return history
@@ -0,0 +1,63 @@
+import click
+import csvsync
+
+from csvsync.cli import csvsync_cli
+from csvsync.config import Config
+from csvsync import api
+from csvsync.lib import *
+
+@csvsync_cli.command("plan")
+@click.argument("filename", required = False)
+@click.option("-a", "--all", "all_files", is_flag = True, default = False,
+              help = "Plan every configured file")
+@click.option("--cached", is_flag = True, default = False,
+              help = "Use the replica's last known remote copy instead of downloading")
+
+def cli_plan(filename, all_files, cached):
+    config = Config()
+
+    if all_files:
+        names = [fileconfig.section_name for fileconfig in config.file_configs()]
+    elif filename:
+        names = [csvsync.cli.find_config(config, filename).section_name]
+    else:
+        raise CLIError("Give a filename, or --all")
+
+    for name in names:
+        try:
+            plan = api.plan(config, name, cached = cached)
+        except CLIError as e:
+            if not all_files:
+                raise
+            eprint(e.message)
+            continue
+
+        print_plan(plan)
+
+def print_plan(plan):
+    print(f"{plan.name}: {plan.status}")
+    print(f"  local -> remote: {describe(plan.to_remote)}")
+    print(f"  remote -> local: {describe(plan.to_local)}")
+
+    if plan.conflicts:
+        print(f"  expected conflicts: {len(plan.conflicts)} "
+              f"(keys: {', '.join(plan.conflicts[:10])}"
+              f"{', ...' if len(plan.conflicts) > 10 else ''})")
+
+    if plan.upload_requests:
+        print(f"  upload: {plan.upload_requests} requests, "
+              f"{format_bytes(plan.payload_bytes)} payload, "
+              f"about {plan.duration:.1f}s at current quota")
+    else:
+        print("  upload: none needed")
+
+def describe(changes):
+    return f"{len(changes.added)} inserts, {len(changes.changed)} updates, " \
+        f"{len(changes.removed)} deletes"
+
+def format_bytes(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
@@ -2,15 +2,36 @@ import configparser
 import os
 import logging
 
+import csvdiff3
+
 class Config:
     def __init__(self):
         config = configparser.ConfigParser(
             defaults = {'token': 'token.pickle',
+                        'drive_token': 'token-drive.pickle',
                         'credentials': 'credentials.json',
                         'syncdir': 'csvsync',
                         'quote': 'minimal',
                         'lineterminator': 'native',
                         'pad_lines': True,
+                        'export_threshold': 50000,
+                        'upload_chunk_rows': 0,
+                        'upload_concurrency': 4,
+                        'replica': True,
+                        'history': True,
+                        'history_keep': 20,
+                        'history_compression': 'auto',
+                        'lock_wait': 0,
+                        'parallel_parse_bytes': 64 * 1024 * 1024,
+                        'parallel_write_rows': 200000,
+                        'parallel_workers': 0,
+                        'partition_rows': 0,
+                        'partition_retries': 3,
+                        'quota_writes_per_minute': 60,
+                        'compress_requests': True,
+                        'hash_column': '',
+                        'backend': 'gsheet',
+                        'local_dir': 'local_sheets',
                         'debug': False})
         self.config = config
 
@@ -54,6 +75,12 @@ class Config:
 
         raise KeyError
 
+    def file_configs(self):
+        for section_name in self.config:
+            if section_name == 'DEFAULT':
+                continue
+            yield FileConfig(self, self.config[section_name], section_name)
+
     def _matches(self, config_filename, user_filename):
         """
         Checks if a supplied user filename matches the filename stored in a
@@ -88,6 +115,10 @@ class FileConfig:
 
         return filename
 
+    def csv_options(self):
+        return csvdiff3.tools.Options(quote = self.section['quote'],
+                                      lineterminator = self.section['lineterminator'])
+
     def __getitem__(self, key):
         return self.section[key]
 
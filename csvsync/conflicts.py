@@ -0,0 +1,304 @@
+# Conflict index for 3-way merges.
+#
+# When a merge stops with conflicts, we record an index of them: for
+# each conflicting key, the values on each side and where in the
+# merged file the conflict lives (line number and byte range).
+# Conflicts can then be listed and resolved key by key, patching only
+# the affected byte ranges of the file rather than re-processing all
+# of it, and "sync --continue" can check that every indexed conflict
+# has been dealt with.
+#
+# A conflict's region is the block of lines between the merge's
+# conflict markers that holds its rows; if the merge marked the
+# conflict inline instead, it is the record with that key.  A conflict
+# that can't be located in the merge output is still indexed, without
+# a region, and stays unresolved until the file is edited by hand.
+
+from . import diff
+from .lib import CLIError, atomic_write
+
+import io
+import os
+import csv
+import json
+import shutil
+import logging
+
+MARKERS = (b'<<<<<<<', b'|||||||', b'=======', b'>>>>>>>')
+
+def records(file):
+    """
+    Split a binary CSV file into records, yielding
+    (line number, start offset, end offset, bytes) for each.  Lines
+    are joined while a quoted field is still open, so embedded
+    newlines stay within their record.
+    """
+    offset = 0
+    lineno = 1
+    pending = []
+    quotes = 0
+    for line in file:
+        if not pending:
+            start = offset
+            start_line = lineno
+        pending.append(line)
+        quotes += line.count(b'"')
+        offset += len(line)
+        lineno += 1
+
+        if quotes % 2 == 0:
+            yield start_line, start, offset, b''.join(pending)
+            pending = []
+            quotes = 0
+
+    if pending:
+        yield start_line, start, offset, b''.join(pending)
+
+def parse_record(data):
+    text = data.decode(errors = 'replace')
+    return next(csv.reader(io.StringIO(text, newline = '')), [])
+
+def is_marker(data):
+    return data.startswith(MARKERS)
+
+def has_markers(filename):
+    # Conflicting rows are delimited by markers at the start of a line,
+    # but a conflict within a single cell is marked inside the cell
+    with open(filename, 'rb') as file:
+        return any(is_marker(line) or MARKERS[0] in line or MARKERS[3] in line
+                   for line in file)
+
+def find_conflicts(base_filename, local_filename, remote_filename, key):
+    """Find the keys changed differently on both sides of a merge"""
+
+    # Keep just a hash and row number per key: rows stay encoded in
+    # their tables, and only rows changed on both sides are decoded
+    # again for comparison
+    def index_rows(filename):
+        header, rows = diff.read_rows(filename)
+        index = diff.key_index(header, key)
+        hashes = {}
+        numbers = {}
+        for n, row in enumerate(rows):
+            k = diff.row_key(row, index)
+            hashes[k] = diff.row_hash(row)
+            numbers[k] = n
+        return header, rows, hashes, numbers
+
+    header, base_rows, base, base_numbers = index_rows(base_filename)
+    local_header, local_rows, local, local_numbers = index_rows(local_filename)
+    remote_header, remote_rows, remote, remote_numbers = index_rows(remote_filename)
+
+    def lookup(rows, numbers, k):
+        return rows[numbers[k]] if k in numbers else None
+
+    conflicts = []
+    for k in list(dict.fromkeys(list(local) + list(remote) + list(base))):
+        if local.get(k) == base.get(k) or remote.get(k) == base.get(k) or \
+           local.get(k) == remote.get(k):
+            continue
+
+        base_row = lookup(base_rows, base_numbers, k)
+        local_row = lookup(local_rows, local_numbers, k)
+        remote_row = lookup(remote_rows, remote_numbers, k)
+
+        columns = []
+        if local_row is not None and remote_row is not None:
+            for column, name in enumerate(local_header):
+                cells = [row[column] if row is not None and column < len(row) else ''
+                         for row in (base_row, local_row, remote_row)]
+                if cells[1] != cells[0] and cells[2] != cells[0] and cells[1] != cells[2]:
+                    columns.append(name)
+
+            # Changes to different columns of the same row merge cleanly
+            if not columns:
+                continue
+
+        conflicts.append({'key': k, 'columns': columns,
+                          'base': base_row, 'local': local_row, 'remote': remote_row,
+                          'resolved': False})
+
+    return local_header, conflicts
+
+class ConflictIndex:
+    def __init__(self, filename, sync_filename):
+        self.filename = filename
+        self.sync_filename = sync_filename
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        if not self.exists():
+            raise CLIError(f"No conflicts recorded for {self.sync_filename}")
+        with open(self.filename, 'rt') as file:
+            return json.load(file)
+
+    def save(self, index):
+        stat = os.stat(self.sync_filename)
+        index['size'] = stat.st_size
+        index['mtime'] = stat.st_mtime_ns
+        atomic_write(self.filename, json.dumps(index, indent = 1), mode = 'wt')
+
+    def remove(self):
+        if self.exists():
+            os.unlink(self.filename)
+
+    def build(self, base_filename, local_filename, remote_filename, key, merged_filename):
+        """Index the conflicts of a merge whose output is in merged_filename"""
+
+        header, conflicts = find_conflicts(base_filename, local_filename,
+                                           remote_filename, key)
+        by_key = {conflict['key']: conflict for conflict in conflicts}
+        index = diff.key_index(header, key)
+
+        # Walk the merged output once, locating each conflict
+        with open(merged_filename, 'rb') as file:
+            block = None
+            for lineno, start, end, data in records(file):
+                if data.startswith(MARKERS[0]):
+                    block = {'line': lineno, 'start': start, 'keys': []}
+                    continue
+                if block is not None:
+                    if data.startswith(MARKERS[3]):
+                        for k in block['keys']:
+                            by_key[k].update(line = block['line'],
+                                             start = block['start'], end = end)
+                        block = None
+                    elif not is_marker(data):
+                        k = diff.row_key(parse_record(data), index)
+                        if k in by_key and k not in block['keys']:
+                            block['keys'].append(k)
+                    continue
+
+                k = diff.row_key(parse_record(data), index)
+                if k in by_key and 'start' not in by_key[k]:
+                    by_key[k].update(line = lineno, start = start, end = end)
+
+        missing = [conflict['key'] for conflict in conflicts if not located(conflict)]
+        if missing:
+            logging.debug(f"Conflicts not located in merge output: {missing}")
+
+        index = {'header': header, 'key': key, 'conflicts': conflicts}
+        logging.debug(f"Indexed {len(conflicts)} conflicts in {merged_filename}")
+        return index
+
+    def unchanged(self, index):
+        # Has the file been touched since the index was last written?
+        stat = os.stat(self.sync_filename)
+        return stat.st_size == index['size'] and stat.st_mtime_ns == index['mtime']
+
+    def unresolved(self):
+        """
+        Return the keys of any conflicts not yet resolved.  If the file
+        has been edited by hand since the index was written, the
+        indexed offsets can no longer be trusted, so we just check that
+        no conflict markers remain.
+        """
+        index = self.load()
+        pending = [c['key'] for c in index['conflicts'] if not c['resolved']]
+        if not pending or self.unchanged(index):
+            return pending
+        return pending if has_markers(self.sync_filename) else []
+
+    def resolve(self, keys, take, values, options):
+        """
+        Resolve the conflicts for the given keys, taking the "local" or
+        "remote" row and then applying any {column: value} overrides.
+        Only the byte ranges of those conflicts are rewritten.
+        """
+
+        index = self.load()
+        if not self.unchanged(index):
+            raise CLIError(f"{self.sync_filename} has been edited since the conflict "
+                           "index was written; resolve the remaining conflicts by hand")
+
+        conflicts = index['conflicts']
+        by_key = {c['key']: c for c in conflicts}
+        for k in keys:
+            if k not in by_key:
+                raise CLIError(f'No conflict recorded for key "{k}"')
+            if by_key[k]['resolved']:
+                raise CLIError(f'Conflict for key "{k}" is already resolved')
+            if not located(by_key[k]):
+                raise CLIError(f'Conflict for key "{k}" was not located in the merge '
+                               f'output; resolve it by editing {self.sync_filename}')
+
+        # Conflicts sharing one marked region have to be resolved together
+        regions = {}
+        for c in conflicts:
+            if not c['resolved'] and located(c):
+                regions.setdefault((c['start'], c['end']), []).append(c)
+        for k in keys:
+            region = regions[(by_key[k]['start'], by_key[k]['end'])]
+            others = [c['key'] for c in region if c['key'] not in keys]
+            if others:
+                raise CLIError(f'Key "{k}" shares a conflict region with '
+                               f'{", ".join(others)}; resolve them together')
+
+        header = index['header']
+        for (start, end), region in sorted(regions.items(), reverse = True):
+            if region[0]['key'] not in keys:
+                continue
+
+            output = io.StringIO()
+            writer = csv.writer(output, **options.csv_kwargs())
+            for c in region:
+                row = c[take]
+                if values:
+                    row = list(row if row is not None else c['local'] or c['remote'])
+                    for column, value in values.items():
+                        try:
+                            n = header.index(column)
+                        except ValueError:
+                            raise CLIError(f'Unknown column "{column}"')
+                        row += [''] * (n + 1 - len(row))
+                        row[n] = value
+                if row is not None:
+                    writer.writerow(row)
+
+            delta = self.patch(start, end, output.getvalue().encode())
+
+            for c in conflicts:
+                if c in region:
+                    c['resolved'] = True
+                    c['end'] = c['start'] + (end - start) + delta
+                elif located(c) and c['start'] >= end:
+                    c['start'] += delta
+                    c['end'] += delta
+
+        self.save(index)
+
+    def patch(self, start, end, replacement):
+        """Replace bytes [start, end) of the file, returning the change in size"""
+
+        filename = self.sync_filename
+        delta = len(replacement) - (end - start)
+
+        if delta == 0:
+            with open(filename, 'r+b') as file:
+                file.seek(start)
+                file.write(replacement)
+            return 0
+
+        tmp_filename = filename + '.tmp'
+        with open(filename, 'rb') as infile:
+            with open(tmp_filename, 'wb') as outfile:
+                copy_bytes(infile, outfile, start)
+                outfile.write(replacement)
+                infile.seek(end)
+                shutil.copyfileobj(infile, outfile)
+        shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+        return delta
+
+def located(conflict):
+    return 'start' in conflict
+
+def copy_bytes(infile, outfile, length, blocksize = 1024 * 1024):
+    while length > 0:
+        data = infile.read(min(blocksize, length))
+        if not data:
+            break
+        outfile.write(data)
+        length -= len(data)
@@ -0,0 +1,146 @@
+# Shared OAuth credential handling.
+#
+# A CredentialBroker owns the credentials for one token file.  There
+# is a single broker per token file in each process, so every Sheet
+# shares one in-memory credential rather than unpickling and
+# refreshing its own.
+#
+# The broker refreshes the access token in a background thread shortly
+# before it expires, so syncs don't stall on a refresh in the middle of
+# their work.  The token file is protected by a lock file and only ever
+# replaced atomically; before refreshing, the broker re-reads the token
+# file under the lock and adopts a token that another process has
+# already refreshed rather than refreshing it again.
+
+from .lib import FileLock, atomic_write
+
+import os
+import pickle
+import logging
+import datetime
+import threading
+
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+# Refresh this long before the access token expires
+REFRESH_MARGIN = datetime.timedelta(minutes = 5)
+
+brokers = {}
+brokers_lock = threading.Lock()
+
+def get_broker(tokenfile, credfile, scopes):
+    key = os.path.realpath(tokenfile)
+    with brokers_lock:
+        if key not in brokers:
+            brokers[key] = CredentialBroker(tokenfile, credfile, scopes)
+        return brokers[key]
+
+def utcnow():
+    # google-auth keeps expiry times as naive UTC datetimes
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo = None)
+
+class CredentialBroker:
+    def __init__(self, tokenfile, credfile, scopes):
+        self.tokenfile = tokenfile
+        self.credfile = credfile
+        self.scopes = scopes
+        self.lockfile = tokenfile + '.lock'
+        self.lock = threading.Lock()
+        self.creds = None
+        self.timer = None
+
+    def credentials(self, interactive = True):
+        # Without interactive, returns None rather than asking the user
+        # to log in if there is no usable token
+        creds = self.creds
+        if creds and creds.valid:
+            return creds
+
+        with self.lock:
+            if not self.creds or not self.creds.valid:
+                self.load(interactive)
+            return self.creds
+
+    def read_token(self):
+        if not os.path.exists(self.tokenfile):
+            return None
+        with open(self.tokenfile, 'rb') as token:
+            creds = pickle.load(token)
+        if self.scopes and creds.scopes and not creds.has_scopes(self.scopes):
+            logging.debug(f"Token in {self.tokenfile} lacks required scopes")
+            return None
+        return creds
+
+    def write_token(self, creds):
+        atomic_write(self.tokenfile, pickle.dumps(creds))
+
+    def load(self, interactive = True):
+        # Called with self.lock held
+        with FileLock(self.lockfile):
+            creds = self.read_token()
+
+            # If there are no (valid) credentials available, let the user log in.
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    logging.debug("Refreshing expired token")
+                    creds.refresh(Request())
+                elif not interactive:
+                    logging.debug(f"No usable token in {self.tokenfile}")
+                    return
+                else:
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        self.credfile, self.scopes)
+                    creds = flow.run_local_server(port=0)
+                # Save the credentials for the next run
+                self.write_token(creds)
+
+        self.adopt(creds)
+        self.schedule_refresh()
+
+    def adopt(self, creds):
+        # Existing http objects hold a reference to our credentials,
+        # so update them in place rather than replacing them.
+        if self.creds is None:
+            self.creds = creds
+        else:
+            self.creds.token = creds.token
+            self.creds.expiry = creds.expiry
+
+    def schedule_refresh(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        expiry = self.creds.expiry
+        if not expiry or not self.creds.refresh_token:
+            return
+
+        delay = max((expiry - REFRESH_MARGIN - utcnow()).total_seconds(), 0)
+        logging.debug(f"Token refresh scheduled in {delay:.0f}s")
+
+        self.timer = threading.Timer(delay, self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        try:
+            with self.lock:
+                with FileLock(self.lockfile):
+                    creds = self.read_token()
+                    if creds and creds.expiry and \
+                       creds.expiry - REFRESH_MARGIN > utcnow():
+                        # Someone else has already refreshed the token
+                        logging.debug("Adopting token refreshed by another process")
+                    else:
+                        logging.debug("Refreshing token ahead of expiry")
+                        creds = creds or self.creds
+                        creds.refresh(Request())
+                        self.write_token(creds)
+                self.adopt(creds)
+            self.schedule_refresh()
+
+        except Exception as e:
+            # The credentials will still be refreshed on demand if
+            # they do expire; just log the failure.
+            logging.debug(f"Background token refresh failed: {e}")
@@ -0,0 +1,71 @@
+# Key-based row comparison of CSV tables.
+#
+# Used wherever csvsync needs to know which rows differ between two
+# versions of a table (eg. the local file against the last synced
+# ancestor) without running a full 3-way merge.
+
+from .lib import CLIError
+from .table import Table
+
+import csv
+import hashlib
+
+def read_rows(filename):
+    """
+    Read a CSV file, returning its header and the remaining rows as a
+    compact Table
+    """
+    with open(filename, 'rt') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        rows = Table().extend(reader)
+    return header, rows
+
+def key_index(header, key):
+    try:
+        return header.index(key)
+    except ValueError:
+        raise CLIError(f'Key column "{key}" not found in header')
+
+def row_key(row, index):
+    return row[index] if index < len(row) else ''
+
+def row_hash(row):
+    # Trailing empty cells are ignored, so that padded and unpadded
+    # copies of the same line compare equal
+    cells = list(row)
+    while cells and cells[-1] == '':
+        cells.pop()
+    return hashlib.sha1('\x1f'.join(cells).encode()).hexdigest()
+
+class Changes:
+    """Keys added, removed and changed between two versions of a table"""
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def summary(self):
+        return f'{len(self.added)} added, {len(self.removed)} removed, ' \
+            f'{len(self.changed)} changed'
+
+def diff_hashes(old, new):
+    """
+    Compare two {key: row_hash} dictionaries, returning the Changes
+    needed to turn old into new.  Keys are reported in the order they
+    appear in new (for added and changed keys) or old (for removed).
+    """
+    added = [key for key in new if key not in old]
+    removed = [key for key in old if key not in new]
+    changed = [key for key in new if key in old and old[key] != new[key]]
+    return Changes(added, removed, changed)
+
+def hash_rows(rows, index):
+    return {row_key(row, index): row_hash(row) for row in rows}
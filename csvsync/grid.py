@@ -0,0 +1,201 @@
+# Grid-shaped backends, and the A1 notation used to configure them.
+#
+# Everything here is independent of the Google API client, so that
+# backends other than Google Sheets (eg. localsheet) can share it
+# without loading the client.
+
+from . import backend
+from .lib import CLIError
+
+import re
+
+# A1-notation helpers.  Config "range" and "columns" settings are
+# given in A1 notation without a sheet name (eg. "A1:F500", or "A:C,F"),
+# and are converted here into 0-based, end-exclusive GridRange
+# dictionaries as used by the batchUpdate API.
+
+A1_PATTERN = re.compile(r'^([A-Z]*)([0-9]*)(?::([A-Z]*)([0-9]*))?$')
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + (ord(letter) - ord('A') + 1)
+    return index - 1
+
+def column_letters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def parse_a1(a1):
+    match = A1_PATTERN.match(a1.strip().upper())
+    if not match:
+        raise CLIError(f'Invalid A1 range "{a1}"')
+
+    start_col, start_row, end_col, end_row = match.groups()
+    if end_col is None and end_row is None:
+        # A single cell or column ("F", "F3") covers just itself
+        end_col, end_row = start_col, start_row
+
+    # Every range we sync must have a fixed set of columns so that
+    # the CSV columns can be mapped back onto the sheet on upload.
+    if not start_col or not end_col:
+        raise CLIError(f'Range "{a1}" must specify both start and end columns')
+
+    grid = {'startColumnIndex': column_index(start_col),
+            'endColumnIndex': column_index(end_col) + 1,
+            'startRowIndex': int(start_row) - 1 if start_row else 0}
+    if end_row:
+        grid['endRowIndex'] = int(end_row)
+
+    if grid['endColumnIndex'] <= grid['startColumnIndex'] or \
+       grid.get('endRowIndex', grid['startRowIndex'] + 1) <= grid['startRowIndex']:
+        raise CLIError(f'Empty A1 range "{a1}"')
+
+    return grid
+
+def grid_to_a1(grid):
+    start = column_letters(grid['startColumnIndex']) + str(grid['startRowIndex'] + 1)
+    end = column_letters(grid['endColumnIndex'] - 1)
+    if 'endRowIndex' in grid:
+        end += str(grid['endRowIndex'])
+    return f'{start}:{end}'
+
+def grid_width(grid):
+    return grid['endColumnIndex'] - grid['startColumnIndex']
+
+class GridBackend(backend.Backend):
+    """
+    Base for backends holding the table as a grid of cells, like a
+    sheet tab.  Maps the columns of the local CSV file onto the
+    configured ranges of the grid.
+    """
+
+    sheet_id = 0
+    hash_column = None
+    ranges = None
+
+    def configured_ranges(self):
+        # By default we sync the entire sheet tab.  A file config can
+        # instead restrict the sync to a single A1 "range", or to a
+        # set of "columns" (eg. "A:C,F"); any cells outside those are
+        # never downloaded, merged or overwritten on upload.
+        #
+        # Returns None for a whole-sheet sync, else a list of GridRanges
+        # in the order their columns appear in the local CSV.
+
+        section = self.fileconfig.section
+        range_config = section.get('range', '').strip()
+        columns_config = section.get('columns', '').strip()
+
+        if range_config and columns_config:
+            raise CLIError(f'File {self.fileconfig.section_name}: '
+                           'only one of "range" and "columns" may be set')
+
+        if range_config:
+            specs = [range_config]
+        elif columns_config:
+            specs = [spec for spec in columns_config.split(',') if spec.strip()]
+        elif self.hash_column is not None:
+            # The checksum column must stay out of the synced data, so
+            # a whole-sheet sync covers just the columns left of it
+            if self.hash_column == 0:
+                raise CLIError(f'File {self.fileconfig.section_name}: '
+                               'hash_column must not be column A')
+            specs = [f'A:{column_letters(self.hash_column - 1)}']
+        else:
+            return None
+
+        ranges = []
+        for spec in specs:
+            grid = parse_a1(spec)
+            grid['sheetId'] = self.sheet_id
+            ranges.append(grid)
+
+        if self.hash_column is not None:
+            for grid in ranges:
+                if grid['startColumnIndex'] <= self.hash_column < grid['endColumnIndex']:
+                    raise CLIError(f'File {self.fileconfig.section_name}: hash_column '
+                                   f'lies within synced range {grid_to_a1(grid)}')
+                if grid['startRowIndex'] != ranges[0]['startRowIndex']:
+                    raise CLIError(f'File {self.fileconfig.section_name}: hash_column '
+                                   'needs all synced ranges to start on the same row')
+
+        return ranges
+
+    def configured_hash_column(self):
+        # Optional column (eg. "ZZ") in which the sheet keeps a
+        # checksum of every row, letting downloads fetch only the rows
+        # which changed since the last sync
+        letters = self.fileconfig.section.get('hash_column', '').strip().upper()
+        if not letters:
+            return None
+        if not re.fullmatch('[A-Z]+', letters):
+            raise CLIError(f'File {self.fileconfig.section_name}: '
+                           f'invalid hash_column "{letters}"')
+        return column_index(letters)
+
+    def column_spans(self):
+        # The (offset, width) of each configured range's columns within
+        # a CSV row, or None if we're syncing the whole sheet.  Cells
+        # outside the configured ranges are left untouched.
+
+        if self.ranges is None:
+            return None
+
+        spans = []
+        offset = 0
+        for grid in self.ranges:
+            spans.append((offset, grid_width(grid)))
+            offset += grid_width(grid)
+        return spans
+
+    def check_width(self, table, first = 0):
+        # Refuse to upload rows with data beyond the configured ranges
+        if self.ranges is None:
+            return
+
+        total_width = self.data_width()
+        too_wide = table.first_too_wide(total_width)
+        if too_wide is not None:
+            raise CLIError(f'Line {first + too_wide + 1} has {len(table[too_wide])} '
+                           f'columns, but only {total_width} columns are '
+                           f'configured for upload')
+
+    def data_width(self):
+        return sum([grid_width(grid) for grid in self.ranges])
+
+    def sheet_column(self, csv_column):
+        # The sheet column index holding a given CSV column, or None
+        for (offset, width), grid in zip(self.column_spans(), self.ranges):
+            if offset <= csv_column < offset + width:
+                return grid['startColumnIndex'] + csv_column - offset
+        return None
+
+    def stitch_ranges(self, range_values, nrows = None):
+        # Yield the rows of values fetched for each configured range,
+        # side by side
+        if nrows is None:
+            nrows = max([len(values) for values in range_values], default = 0)
+
+        for i in range(nrows):
+            row = []
+            for n, (grid, values) in enumerate(zip(self.ranges, range_values)):
+                cells = values[i] if i < len(values) else []
+                if n < len(self.ranges) - 1:
+                    cells = cells + [''] * (grid_width(grid) - len(cells))
+                row += cells
+            yield row
+
+    def stitched_row(self, row):
+        # A CSV row as stitch_ranges would have returned it from the
+        # sheet: trailing empty cells dropped, except that every range
+        # but the last is padded to its full width
+        row = list(row[:self.data_width()])
+        while row and row[-1] == '':
+            row.pop()
+        padded_width = self.data_width() - grid_width(self.ranges[-1])
+        return row + [''] * (padded_width - len(row))
@@ -1,49 +1,190 @@
-from . import config
-from .lib import eprint
+from . import config, aio, credentials, parallel, diff
+from .grid import GridBackend, column_index, column_letters, parse_a1, grid_to_a1, grid_width
+from .lib import eprint, CLIError
+from .table import Table
 
-import pickle
 import os.path
 import io
+import gzip
+import hashlib
+import urllib.parse
 from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient.errors import HttpError
+from google.auth.transport.requests import AuthorizedSession
 import csv
-
-import csvdiff3
-
-# If modifying these scopes, delete the file token.pickle.
+import logging
+import functools
+import threading
+import httplib2
+import google_auth_httplib2
+
+# If modifying these scopes, tokens lacking the new scopes will be
+# discarded and the user asked to log in again.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# Drive metadata access is needed only to read the Drive changes feed.
+# It is kept in a token file of its own ("drive_token"), so that the
+# Sheets-only token used by every other command stays valid.
+DRIVE_SCOPES = SCOPES + ['https://www.googleapis.com/auth/drive.metadata.readonly']
+
 class Auth:
-    def __init__(self, fileconfig):
+    def __init__(self, fileconfig, token = 'token', scopes = SCOPES, interactive = True):
         self.credfile = fileconfig.expand_config_filename('credentials')
-        self.tokenfile = fileconfig.expand_config_filename('token')
+        self.tokenfile = fileconfig.expand_config_filename(token)
 
-        creds = None
         # The file token.pickle stores the user's access and refresh
         # tokens, and is created automatically when the authorization
-        # flow completes for the first time.
-        if os.path.exists(self.tokenfile):
-            with open(self.tokenfile, 'rb') as token:
-                creds = pickle.load(token)
-
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credfile, SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(self.tokenfile, 'wb') as token:
-                pickle.dump(creds, token)
-
-        self.creds = creds
+        # flow completes for the first time.  All Auth objects using
+        # the same token file share one credential broker.  Without
+        # interactive, creds is None if the user would have to log in.
+        broker = credentials.get_broker(self.tokenfile, self.credfile, scopes)
+        self.creds = broker.credentials(interactive)
+
+def chunk_range(grid, nrows, chunk_rows):
+    """
+    Split the rows to be uploaded to a GridRange into chunks of at
+    most chunk_rows rows, yielding (GridRange, start, stop) for each
+    chunk.
+
+    Every chunk but the last is bounded to exactly its own rows so
+    that chunks can be uploaded concurrently without overlapping.  The
+    last chunk keeps the original end of the range, so that it still
+    clears any trailing lines beyond the data uploaded.
+    """
+    if chunk_rows <= 0 or nrows <= chunk_rows:
+        yield grid, 0, nrows
+        return
+
+    for start in range(0, nrows, chunk_rows):
+        stop = min(start + chunk_rows, nrows)
+        chunk_grid = dict(grid, startRowIndex = grid['startRowIndex'] + start)
+        if stop < nrows:
+            chunk_grid['endRowIndex'] = chunk_grid['startRowIndex'] + stop - start
+        yield chunk_grid, start, stop
+
+# Row checksums.  With a "hash_column" configured, the sheet itself
+# computes a checksum of every row in that (hidden) column, using a
+# single array formula.  Since the sheet computes it, the checksum also
+# follows any edits made by hand.  row_checksum() computes exactly the
+# same value locally, so rows can be compared without downloading them.
+#
+# The checksum is a pair of polynomial hashes of the code points of
+# the row's cells joined by a unit separator, each with its own base
+# and prime modulus.  The moduli are below 2**26 and the bases below
+# 2**20, so every intermediate value stays well inside the 2**53 that
+# a sheet holds exactly.  Any row where the two sides disagree (eg.
+# numbers formatted differently) is simply downloaded in full.
+
+CHECKSUM_SEPARATOR = '\x1f'
+
+# (base, modulus) of each hash
+CHECKSUM_HASHES = ((1000003, 67108859), (999983, 67108837))
+
+def checksum_formula(refs):
+    rows = refs[0] if len(refs) == 1 else '{' + ', '.join(refs) + '}'
+    hashes = ' & "." & '.join([f'TEXT(REDUCE(0, c, LAMBDA(h, x, MOD(h * {base} + x, {modulus}))), "0")'
+                               for base, modulus in CHECKSUM_HASHES])
+    return f'=BYROW({rows}, LAMBDA(r, IF(COUNTA(r) = 0, "", ' \
+        f'LET(t, TEXTJOIN(CHAR({ord(CHECKSUM_SEPARATOR)}), FALSE, r), ' \
+        f'c, UNICODE(MID(t, SEQUENCE(LEN(t)), 1)), {hashes}))))'
+
+def polynomial_hash(codes, base, modulus):
+    value = 0
+    for code in codes:
+        value = (value * base + code) % modulus
+    return value
+
+def row_checksum(row, width):
+    cells = list(row[:width]) + [''] * (width - len(row))
+    if not any(cells):
+        return ''
+    codes = [ord(char) for char in CHECKSUM_SEPARATOR.join(cells)]
+    return '.'.join([str(polynomial_hash(codes, base, modulus))
+                     for base, modulus in CHECKSUM_HASHES])
+
+class CompressedHttp(httplib2.Http):
+    """
+    httplib2 transport which gzips request bodies, asks for gzipped
+    responses, and logs the bytes actually sent and received for
+    each request.
+    """
+
+    # Smaller request bodies aren't worth compressing
+    MIN_COMPRESS_BYTES = 1024
+
+    def __init__(self, compress_requests = True, **kwargs):
+        super().__init__(**kwargs)
+        self.compress_requests = compress_requests
+        self.received = 0
+
+    def request(self, uri, method = 'GET', body = None, headers = None, *args, **kwargs):
+        headers = dict(headers or {})
+        headers['accept-encoding'] = 'gzip'
+
+        # Google APIs only compress responses for user agents
+        # mentioning gzip
+        agent = headers.get('user-agent', 'csvsync')
+        if 'gzip' not in agent:
+            headers['user-agent'] = f'{agent} (gzip)'
+
+        if self.compress_requests and body is not None and \
+           len(body) >= self.MIN_COMPRESS_BYTES and 'content-encoding' not in headers:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            body = gzip.compress(body)
+            headers['content-encoding'] = 'gzip'
+
+        self.received = 0
+        response, content = super().request(uri, method, body, headers, *args, **kwargs)
+
+        sent = len(body) if body is not None else 0
+        logging.debug(f"HTTP {method} {urllib.parse.urlsplit(uri).path}: "
+                      f"sent {sent} bytes{' gzipped' if 'content-encoding' in headers else ''}, "
+                      f"received {self.received} bytes"
+                      f"{' gzipped' if '-content-encoding' in response else ''} "
+                      f"({len(content)} uncompressed)")
+        return response, content
+
+    def _conn_request(self, conn, request_uri, method, body, headers):
+        # Count the response body as read off the connection, before
+        # httplib2 decompresses it
+        getresponse = conn.getresponse
+
+        def counting_getresponse():
+            response = getresponse()
+            read = response.read
+
+            def counting_read(*args):
+                data = read(*args)
+                self.received += len(data)
+                return data
+
+            response.read = counting_read
+            return response
+
+        conn.getresponse = counting_getresponse
+        try:
+            return super()._conn_request(conn, request_uri, method, body, headers)
+        finally:
+            conn.getresponse = getresponse
+
+class Sheet(GridBackend):
+    # Endpoint used to export a single tab as CSV for large downloads
+    EXPORT_URL = 'https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export'
+    EXPORT_CHUNK_SIZE = 1024 * 1024
+
+    # The exported CSV is always minimally quoted with CRLF line endings
+    EXPORT_QUOTING = csv.QUOTE_MINIMAL
+    EXPORT_LINETERMINATOR = '\r\n'
+
+    # Developer metadata key for the version stamp csvsync writes to
+    # the sheet with each upload
+    VERSION_KEY = 'csvsync.version'
 
-class Sheet:
     def __init__(self, fileconfig, auth):
         self.fileconfig = fileconfig
+        self.auth = auth
+        self.local = threading.local()
 
         # Find all the sheet tabs from the given spreadsheet
 
@@ -52,9 +193,10 @@ class Sheet:
         self.spreadsheet_id = fileconfig['spreadsheet_id']
 
         sheets_with_properties = \
-            self.service \
-            .get(spreadsheetId = self.spreadsheet_id, fields = 'sheets.properties') \
-            .execute() \
+            self.execute(
+                self.service \
+                .get(spreadsheetId = self.spreadsheet_id,
+                     fields = 'sheets.properties(sheetId,title,gridProperties.rowCount)')) \
             .get('sheets')
 
         # If the user has requested a specific sheet/tab by name, find that now.
@@ -68,92 +210,625 @@ class Sheet:
                 if sheet['properties']['title'] == find_sheet:
                     self.sheet_id = sheet['properties']['sheetId']
                     self.sheet_name = find_sheet
+                    self.row_count = sheet['properties'] \
+                        .get('gridProperties', {}) \
+                        .get('rowCount', 0)
                     break
 
         assert self.sheet_id != None
         print ('Found sheet "%s" at id %d' % (find_sheet, self.sheet_id))
 
-    def save_to_csv(self, filename, pad_lines = True):
-        range = self.sheet_name
-
-        result = self.service \
-            .values() \
-            .get(spreadsheetId = self.spreadsheet_id, range = range) \
-            .execute()
-
-        values = result.get('values', [])
-
-        print (f'Loaded {len(values)} lines from sheet')
+        self.hash_column = self.configured_hash_column()
+        self.ranges = self.configured_ranges()
+        self.version_exists = None
+        self.drive_service = None
+
+    @classmethod
+    def open(cls, fileconfig):
+        return cls(fileconfig, Auth(fileconfig))
+
+    @classmethod
+    def changes_feed(cls, config, fileconfig):
+        # Spreadsheets changed remotely are found from the Drive
+        # changes feed
+        from . import changes
+        return changes.ChangesFeed(config, fileconfig)
+
+    def execute(self, request):
+        # Execute an API request using an http object private to the
+        # calling thread, so that requests may safely be issued from
+        # several worker threads at once.
+
+        try:
+            http = self.local.http
+        except AttributeError:
+            compress = self.fileconfig.section.getboolean('compress_requests')
+            http = google_auth_httplib2.AuthorizedHttp(
+                self.auth.creds, http = CompressedHttp(compress_requests = compress))
+            self.local.http = http
+
+        return request.execute(http = http)
+
+    def batch_update(self, body):
+        return self.execute(
+            self.service \
+            .batchUpdate(spreadsheetId = self.spreadsheet_id, body = body,
+                         fields = 'spreadsheetId'))
+
+    def version_filter(self):
+        return {
+            'developerMetadataLookup': {
+                'metadataKey': self.VERSION_KEY,
+                'metadataLocation': {'sheetId': self.sheet_id}
+            }
+        }
 
-        max_len = max([len(row) for row in values])
+    def read_version(self):
+        # Read the version stamp of the last csvsync upload to this
+        # sheet, or None if there isn't one.  This is a single small
+        # metadata lookup.
 
-        quote = self.fileconfig["quote"]
-        lineterminator = self.fileconfig["lineterminator"]
-        options = csvdiff3.tools.Options(quote = quote, lineterminator = lineterminator)
+        result = self.execute(
+            self.service \
+            .developerMetadata() \
+            .search(spreadsheetId = self.spreadsheet_id,
+                    body = {'dataFilters': [self.version_filter()]},
+                    fields = 'matchedDeveloperMetadata.developerMetadata.metadataValue'))
+
+        matched = result.get('matchedDeveloperMetadata', [])
+        self.version_exists = bool(matched)
+        if not matched:
+            return None
+        return matched[0]['developerMetadata'].get('metadataValue')
+
+    def read_revision(self):
+        # The version stamp only changes with csvsync uploads, so edits
+        # made in the Sheets UI are caught by one of:
+        #
+        # - The spreadsheet's Drive version, which changes with every
+        #   edit (to any of its tabs), if the changes feed's Drive
+        #   token is already in place.  One small files.get call.
+        # - Otherwise, a digest of the sheet's row checksums, if it
+        #   keeps them.  This reads the whole hash column.
+        #
+        # With neither, returns None and pushes always merge.
+
+        revision = self.read_drive_version()
+        if revision is None and self.hash_column is not None:
+            revision = self.read_checksums_digest()
+        logging.debug(f"Revision: {revision}")
+        return revision
+
+    def read_drive_version(self):
+        if self.drive_service is None:
+            # Never ask the user to log in just for this
+            if not os.path.exists(self.fileconfig.expand_config_filename('drive_token')):
+                return None
+            auth = Auth(self.fileconfig, 'drive_token', DRIVE_SCOPES, interactive = False)
+            if not auth.creds:
+                return None
+            self.drive_service = build('drive', 'v3', credentials = auth.creds,
+                                       cache_discovery = False)
+
+        try:
+            result = self.drive_service.files() \
+                .get(fileId = self.spreadsheet_id, fields = 'version',
+                     supportsAllDrives = True) \
+                .execute()
+        except HttpError as e:
+            logging.debug(f"Drive version lookup failed: {e}")
+            return None
+        return f"drive:{result['version']}"
+
+    def read_checksums_digest(self):
+        grid = {'startRowIndex': self.ranges[0]['startRowIndex'],
+                'startColumnIndex': self.hash_column,
+                'endColumnIndex': self.hash_column + 1}
+        result = self.execute(
+            self.service \
+            .values() \
+            .get(spreadsheetId = self.spreadsheet_id, range = self.a1_range(grid),
+                 majorDimension = 'COLUMNS', fields = 'values'))
+        checksums = (result.get('values') or [[]])[0]
+        return 'checksums:' + hashlib.sha256('\n'.join(checksums).encode()).hexdigest()
+
+    def version_request(self, version):
+        # Request to set the version stamp, to be sent in the same
+        # batchUpdate as the data it describes.
+
+        if self.version_exists is None:
+            self.read_version()
+
+        if self.version_exists:
+            return {
+                'updateDeveloperMetadata': {
+                    'dataFilters': [self.version_filter()],
+                    'developerMetadata': {'metadataValue': version},
+                    'fields': 'metadataValue'
+                }
+            }
+
+        self.version_exists = True
+        return {
+            'createDeveloperMetadata': {
+                'developerMetadata': {
+                    'metadataKey': self.VERSION_KEY,
+                    'metadataValue': version,
+                    'location': {'sheetId': self.sheet_id},
+                    'visibility': 'DOCUMENT'
+                }
+            }
+        }
 
-        with open(filename, 'wt') as csvfile:
-            csvwriter = csv.writer(csvfile, **options.csv_kwargs())
-            for row in values:
-                if pad_lines:
-                    row += [''] * (max_len - len(row))
-                csvwriter.writerow(row)
-
-    def load_from_csv(self, filename):
-        values = []
-
-        # Read in the CSV file
-
-        with open(filename, 'rt') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                values.append(row)
-
-        # Now construct a list of google API-compatible rows from that data
-
-        rowdata = []
-        for row in values:
-            cells = []
-            for cell in row:
-                if isinstance(cell, int) or isinstance(cell, float):
-                    celltype = "numberValue"
-                    cellval = float(cell)
-                else:
-                    celltype = "stringValue"
-                    cellval = str(cell)
-                cells.append({
-                    'userEnteredValue':
-                    {
-                        celltype: cellval
-                    }
-                })
-            rowdata.append({
-                'values': cells
-                })
-
-        requests = [
-            # Update the main content of the spreadsheet with the new
-            # values constructed from the CSV.  A startRowIndex of 0
-            # with no endRowIndex will cause a complete replace of the
-            # sheet, including culling any trailing lines beyond the
-            # data uploaded.
+    def hash_requests(self):
+        # Requests (re)writing the checksum formula at the top of the
+        # hash column, and keeping the column hidden.  These are sent
+        # with every upload, which is cheap and repairs the formula if
+        # anyone has removed it.
+
+        if self.hash_column is None:
+            return []
+
+        refs = [grid_to_a1(dict(grid, sheetId = self.sheet_id)) for grid in self.ranges]
+        start = self.ranges[0]['startRowIndex']
+        formula_grid = {'sheetId': self.sheet_id,
+                        'startRowIndex': start, 'endRowIndex': start + 1,
+                        'startColumnIndex': self.hash_column,
+                        'endColumnIndex': self.hash_column + 1}
+        formula = [{'values': [{'userEnteredValue': {'formulaValue': checksum_formula(refs)}}]}]
+
+        return [
+            self.update_cells_request(formula, formula_grid),
             {
-                'updateCells': {
-                    'range': {
-                        'sheetId': self.sheet_id,
-                        'startRowIndex': 0,
-                    },
-                    'fields': 'userEnteredValue',
-                    'rows': rowdata
+                'updateDimensionProperties': {
+                    'range': {'sheetId': self.sheet_id, 'dimension': 'COLUMNS',
+                              'startIndex': self.hash_column,
+                              'endIndex': self.hash_column + 1},
+                    'properties': {'hiddenByUser': True},
+                    'fields': 'hiddenByUser'
                 }
-            }]
+            }
+        ]
+
+    def a1_range(self, grid):
+        quoted_name = self.sheet_name.replace("'", "''")
+        return f"'{quoted_name}'!{grid_to_a1(grid)}"
+
+    def a1_rows(self, first, last):
+        # Whole rows [first, last) of the tab
+        quoted_name = self.sheet_name.replace("'", "''")
+        return f"'{quoted_name}'!{first + 1}:{last}"
+
+    def use_export(self):
+        # Very large whole-sheet downloads go through the CSV export
+        # endpoint rather than the values API, avoiding the overhead
+        # of transferring and parsing the values as nested JSON.
+
+        if self.ranges is not None:
+            return False
+
+        threshold = self.fileconfig.section.getint('export_threshold', 0)
+        return threshold > 0 and self.row_count > threshold
+
+    def save_to_csv(self, filename, pad_lines = True, base_filename = None):
+        # If we keep row checksums and have the contents as of the last
+        # sync in base_filename, only rows which changed since then
+        # are downloaded
+        table = None
+        if self.hash_column is not None and base_filename and os.path.exists(base_filename):
+            table = self.get_changed_rows(base_filename)
+
+        if table is None:
+            if self.use_export():
+                return self.export_to_csv(filename, pad_lines)
+            table = self.get_all_rows()
+
+        print (f'Loaded {len(table)} lines from sheet')
+
+        options = self.fileconfig.csv_options()
+
+        # Very large downloads are formatted as CSV in parallel
+        parallel_rows = self.fileconfig.section.getint('parallel_write_rows', 0)
+        if parallel_rows > 0 and len(table) > parallel_rows:
+            workers = self.fileconfig.section.getint('parallel_workers', 0) or None
+            with open(filename, 'wt') as csvfile:
+                parallel.write_rows(csvfile, table, options.csv_kwargs(),
+                                    pad_to = table.max_width if pad_lines else None,
+                                    workers = workers)
+            return
 
-        body = {
-            'requests': requests
-        }
+        with open(filename, 'wt') as csvfile:
+            table.write_csv(csvfile, options.csv_kwargs(), pad_lines)
+
+    # Rows fetched by each values request of a full download
+    DOWNLOAD_PAGE_ROWS = 10000
+
+    def get_all_rows(self):
+        # Fetch the rows a page at a time, adding each page to a
+        # compact table and dropping its JSON before the next is
+        # fetched, so that the download is never all held as nested
+        # JSON.  Pages stop at the end of the grid, beyond which there
+        # can be no data.  The values API drops empty rows at the end
+        # of each page, which are put back only if more data follows.
+
+        table = Table()
+        blank = [] if self.ranges is None else self.stitched_row([])
+        nrows = self.download_rows()
+        missing = 0
+        for first in range(0, nrows, self.DOWNLOAD_PAGE_ROWS):
+            last = min(first + self.DOWNLOAD_PAGE_ROWS, nrows)
+            rows = self.get_page(first, last)
+            if rows:
+                table.extend([blank] * missing)
+                table.extend(rows)
+                missing = last - first - len(rows)
+            else:
+                missing += last - first
+            del rows
+
+        return table
+
+    def download_rows(self):
+        # Number of rows a full download covers, from the sheet's
+        # metadata and any configured range
+        if self.ranges is None:
+            return self.row_count
+        return max([self.range_end(grid) - grid['startRowIndex'] for grid in self.ranges] + [0])
+
+    def range_end(self, grid):
+        # The end row of a range, within the grid
+        return min(grid.get('endRowIndex', self.row_count), self.row_count)
+
+    def get_page(self, first, last):
+        # Rows [first, last) of the synced data, as lists of cells
+        if self.ranges is None:
+            result = self.execute(
+                self.service \
+                .values() \
+                .get(spreadsheetId = self.spreadsheet_id,
+                     range = self.a1_rows(first, last),
+                     fields = 'values'))
+            return result.pop('values', [])
+
+        # Fetch the page of every configured range in one call, then
+        # stitch them together side by side.  Every range except the
+        # last is padded out to its full width so that later columns
+        # stay aligned.
+        grids = []
+        for grid in self.ranges:
+            start = grid['startRowIndex']
+            end = min(start + last, self.range_end(grid))
+            if start + first < end:
+                grids.append(dict(grid, startRowIndex = start + first, endRowIndex = end))
+            else:
+                # Past the end of this range
+                grids.append(None)
 
-        eprint (f'Uploading {len(values)} lines...')
+        fetch = [grid for grid in grids if grid is not None]
+        if not fetch:
+            return []
+
+        result = self.execute(
+            self.service \
+            .values() \
+            .batchGet(spreadsheetId = self.spreadsheet_id,
+                      ranges = [self.a1_range(grid) for grid in fetch],
+                      majorDimension = 'ROWS',
+                      fields = 'valueRanges.values'))
+
+        value_ranges = iter(result.pop('valueRanges', []))
+        range_values = [next(value_ranges).get('values', []) if grid is not None else []
+                        for grid in grids]
+        return list(self.stitch_ranges(range_values))
+
+    def export_to_csv(self, filename, pad_lines = True):
+        # Stream the tab's CSV export straight into the download file.
+        #
+        # The export already pads every line to the full width of the
+        # data, so it can be used as-is if it also matches our
+        # configured quoting and line terminator.  Otherwise we stream
+        # it to a temporary file first and re-quote it from there.
+
+        url = self.EXPORT_URL.format(spreadsheet_id = self.spreadsheet_id)
+        params = {'format': 'csv', 'gid': self.sheet_id}
+
+        requote = not pad_lines or not self.export_matches_options()
+        export_filename = filename + '.EXPORT' if requote else filename
+
+        eprint (f'Exporting {self.row_count} lines from sheet as CSV...')
+
+        session = AuthorizedSession(self.auth.creds)
+        with session.get(url, params = params, stream = True) as response:
+            response.raise_for_status()
+
+            last = b''
+            with open(export_filename, 'wb') as csvfile:
+                for chunk in response.iter_content(chunk_size = self.EXPORT_CHUNK_SIZE):
+                    if chunk:
+                        csvfile.write(chunk)
+                        last = chunk
+
+                # The export omits the final line terminator
+                if last and not last.endswith(b'\n'):
+                    csvfile.write(self.EXPORT_LINETERMINATOR.encode())
+
+            # requests asks for a gzipped export by default; the raw
+            # stream's position counts the bytes as received
+            logging.debug(f"HTTP GET {urllib.parse.urlsplit(url).path}: "
+                          f"received {response.raw.tell()} bytes"
+                          f"{' gzipped' if response.headers.get('content-encoding') == 'gzip' else ''}")
+
+        if requote:
+            self.requote_csv(export_filename, filename, pad_lines)
+            os.unlink(export_filename)
+
+    def export_matches_options(self):
+        kwargs = self.fileconfig.csv_options().csv_kwargs()
+        dialect = csv.writer(io.StringIO(), **kwargs).dialect
+        return dialect.quoting == self.EXPORT_QUOTING and \
+            dialect.lineterminator == self.EXPORT_LINETERMINATOR
+
+    def requote_csv(self, from_filename, to_filename, pad_lines = True):
+        options = self.fileconfig.csv_options()
+        lines = 0
+
+        with open(from_filename, 'rt', newline = '', encoding = 'utf-8') as infile:
+            with open(to_filename, 'wt') as outfile:
+                reader = csv.reader(infile)
+                writer = csv.writer(outfile, **options.csv_kwargs())
+                for row in reader:
+                    if not pad_lines:
+                        # Match the values API, which drops trailing
+                        # empty cells from each line
+                        while row and row[-1] == '':
+                            row.pop()
+                    writer.writerow(row)
+                    lines += 1
+
+        logging.debug(f"Re-quoted {lines} exported lines into {to_filename}")
+
+    # Rows further apart than this are fetched as separate ranges
+    FETCH_GAP = 50
+    # Most ranges fetched by a single batchGet
+    FETCH_RANGES = 100
+
+    def get_changed_rows(self, base_filename):
+        # Rebuild the sheet contents from the last synced contents,
+        # fetching in full only rows whose checksum on the sheet
+        # doesn't match any row with the same key there.  Returns None
+        # if a full download is needed instead.
+
+        header, base_rows = diff.read_rows(base_filename)
+        key = self.fileconfig['key']
+        column = self.sheet_column(header.index(key)) if key in header else None
+        if column is None:
+            return None
+
+        width = self.data_width()
+        start = self.ranges[0]['startRowIndex']
+        probes = [{'sheetId': self.sheet_id, 'startRowIndex': start,
+                   'startColumnIndex': n, 'endColumnIndex': n + 1}
+                  for n in (column, self.hash_column)]
+
+        result = self.execute(
+            self.service \
+            .values() \
+            .batchGet(spreadsheetId = self.spreadsheet_id,
+                      ranges = [self.a1_range(grid) for grid in probes],
+                      majorDimension = 'COLUMNS',
+                      fields = 'valueRanges.values'))
+        keys, checksums = [(value_range.get('values') or [[]])[0]
+                           for value_range in result.get('valueRanges', [])]
+
+        if not checksums or checksums[0] != row_checksum(header, width):
+            logging.debug("CHECKSUMS: header changed or no checksums, full download")
+            return None
+
+        index = diff.key_index(header, key)
+        known = {}
+        for n, row in enumerate(base_rows):
+            known[(diff.row_key(row, index), row_checksum(row, width))] = n
+
+        nrows = max(len(keys), len(checksums))
+        sources = [None] * nrows
+        fetch = []
+        for n in range(1, nrows):
+            checksum = checksums[n] if n < len(checksums) else ''
+            source = known.get((keys[n] if n < len(keys) else '', checksum))
+            if checksum and source is not None:
+                sources[n] = source
+            else:
+                fetch.append(n)
+
+        logging.debug(f"CHECKSUMS: {len(fetch)} of {nrows} rows changed")
+        if len(fetch) > nrows // 2:
+            return None
+
+        # Fetch runs of changed rows, merging runs which are close
+        # together
+        runs = []
+        for n in fetch:
+            if runs and n - runs[-1][1] <= self.FETCH_GAP:
+                runs[-1][1] = n + 1
+            else:
+                runs.append([n, n + 1])
+
+        fetched = {}
+        for first in range(0, len(runs), self.FETCH_RANGES):
+            batch = runs[first:first + self.FETCH_RANGES]
+            grids = [dict(grid, startRowIndex = start + a, endRowIndex = start + b)
+                     for a, b in batch for grid in self.ranges]
+            result = self.execute(
+                self.service \
+                .values() \
+                .batchGet(spreadsheetId = self.spreadsheet_id,
+                          ranges = [self.a1_range(grid) for grid in grids],
+                          majorDimension = 'ROWS',
+                          fields = 'valueRanges.values'))
+            value_ranges = result.get('valueRanges', [])
+            for i, (a, b) in enumerate(batch):
+                range_values = [value_range.get('values', []) for value_range in
+                                value_ranges[i * len(self.ranges):(i + 1) * len(self.ranges)]]
+                for n, row in enumerate(self.stitch_ranges(range_values, b - a), a):
+                    fetched[n] = row
+
+        eprint (f'Fetched {len(fetched)} lines for {len(fetch)} changed lines of {nrows}')
+
+        table = Table()
+        table.append(self.stitched_row(header))
+        for n in range(1, nrows):
+            if n in fetched:
+                table.append(fetched[n])
+            else:
+                table.append(self.stitched_row(base_rows[sources[n]]))
+        return table
+
+    def load_from_csv(self, filename, version = None):
+        section = self.fileconfig.section
+
+        # Read in the CSV file as a compact table.  Very large files
+        # are parsed in parallel.
+
+        parallel_bytes = section.getint('parallel_parse_bytes', 0)
+        if parallel_bytes > 0 and os.path.getsize(filename) > parallel_bytes:
+            table = self.parse_parallel(filename)
+        else:
+            table = Table.from_csv(filename)
+        self.check_width(table)
+        nrows = len(table)
+
+        if self.ranges is None:
+            ranges = [self.whole_sheet_range()]
+        else:
+            ranges = self.ranges
+
+        for grid in ranges:
+            if 'endRowIndex' in grid and \
+               nrows > grid['endRowIndex'] - grid['startRowIndex']:
+                raise CLIError(f'{nrows} lines will not fit in '
+                               f'configured range {grid_to_a1(grid)}')
+
+        # If upload_chunk_rows is set, large uploads are split into
+        # chunks of rows, which are sent as separate batchUpdate calls
+        # running concurrently.  The API row data for each chunk is
+        # only built just before it is sent, so that at most a few
+        # chunks' worth is held at once.  A chunked upload is no longer
+        # atomic, so this is off by default.
+
+        chunk_rows = section.getint('upload_chunk_rows', 0)
+        concurrency = section.getint('upload_concurrency', 1)
+
+        bodies = []
+        for grid, (offset, width) in zip(ranges, self.column_spans() or [(0, None)]):
+            for chunk_grid, start, stop in chunk_range(grid, nrows, chunk_rows):
+                bodies.append(functools.partial(
+                    self.update_cells_body, table, start, stop, offset, width, chunk_grid))
+
+        if len(bodies) > 1 and concurrency > 1:
+            # Several chunks: send them all concurrently, then stamp
+            # the new version once they have all succeeded
+            eprint (f'Uploading {nrows} lines in {len(bodies)} chunks...')
+            aio.complete(aio.AsyncSheet(self).batch_update_all(bodies, concurrency))
+            final = self.final_requests(version)
+            if final:
+                self.batch_update({'requests': final})
+        else:
+            # Otherwise keep everything, version stamp included, in one
+            # single atomic batchUpdate
+            eprint (f'Uploading {nrows} lines...')
+            requests = [request for body in bodies for request in body()['requests']]
+            requests += self.final_requests(version)
+            self.batch_update({
+                'requests': requests
+            })
+
+    def load_windows(self, windows, total_rows, clear_from = None, retries = 0,
+                     version = None):
+        # Upload only some windows of rows, given as (first row, rows)
+        # pairs, leaving all other rows untouched.  If clear_from is
+        # given, lines from total_rows up to clear_from are cleared.
+        # Windows are uploaded concurrently, and each is retried on
+        # failure on its own.
+
+        if self.ranges is None:
+            ranges = [self.whole_sheet_range()]
+        else:
+            ranges = self.ranges
+        spans = self.column_spans() or [(0, None)]
+
+        bodies = []
+        for first, rows in windows:
+            table = Table.from_rows(rows)
+            self.check_width(table, first)
+
+            requests = []
+            for grid, (offset, width) in zip(ranges, spans):
+                start = grid['startRowIndex'] + first
+                window_grid = dict(grid, startRowIndex = start, endRowIndex = start + len(table))
+                requests += self.update_cells_body(table, 0, len(table), offset, width,
+                                                   window_grid)['requests']
+            bodies.append({'requests': requests})
+
+        if clear_from is not None and clear_from > total_rows:
+            requests = []
+            for grid in ranges:
+                start = grid['startRowIndex']
+                clear_grid = dict(grid, startRowIndex = start + total_rows,
+                                  endRowIndex = start + clear_from)
+                requests.append(self.update_cells_request([], clear_grid))
+            bodies.append({'requests': requests})
+
+        if bodies:
+            concurrency = self.fileconfig.section.getint('upload_concurrency', 1)
+            eprint (f'Uploading {sum([len(rows) for first, rows in windows])} '
+                    f'changed lines in {len(windows)} windows...')
+            aio.complete(aio.AsyncSheet(self).batch_update_all(bodies, concurrency, retries))
+
+        final = self.final_requests(version)
+        if final:
+            self.batch_update({'requests': final})
+
+    def final_requests(self, version):
+        # Requests sent once all the data is in place: the checksum
+        # formula, and the version stamp last of all
+        requests = self.hash_requests()
+        if version:
+            requests.append(self.version_request(version))
+        return requests
+
+    def parse_parallel(self, filename):
+        # Each worker parses its chunk of the file into a table of its
+        # own, which is much cheaper to send back than lists of rows
+        workers = self.fileconfig.section.getint('parallel_workers', 0) or None
+        table = Table()
+        for chunk in parallel.map_csv_chunks(filename, Table.from_rows, (), workers):
+            table.extend_table(chunk)
+        return table
+
+    def whole_sheet_range(self):
+        # A startRowIndex of 0 with no endRowIndex will cause a
+        # complete replace of the sheet, including culling any
+        # trailing lines beyond the data uploaded.
+        return {
+            'sheetId': self.sheet_id,
+            'startRowIndex': 0,
+        }
 
-        result = self.service \
-            .batchUpdate(spreadsheetId = self.spreadsheet_id,
-                         body = body
-            ).execute()
+    def update_cells_body(self, table, start, stop, offset, width, grid):
+        # A batchUpdate body uploading rows [start, stop) of a table,
+        # limited to the given columns, to a range
+        rowdata = table.row_data(start, stop, offset,
+                                 None if width is None else offset + width)
+        return {'requests': [self.update_cells_request(rowdata, grid)]}
+
+    def update_cells_request(self, rowdata, grid):
+        # The update covers the whole of the given range: any cells in
+        # the range not covered by the new data are cleared.
+
+        return {
+            'updateCells': {
+                'range': grid,
+                'fields': 'userEnteredValue',
+                'rows': rowdata
+            }
+        }
@@ -0,0 +1,302 @@
+# Content-addressed, compressed history of sync artifacts.
+#
+# Every download, local copy and ancestor recorded during a sync is
+# stored as a snapshot in the syncdir.  Snapshot contents are split
+# into chunks of whole lines at content-defined boundaries, so that an
+# insertion or deletion only disturbs the chunk around it and all
+# other chunks are shared with earlier snapshots.  Each chunk is
+# compressed (with zstd if available, else gzip) and stored once under
+# its SHA-256 in the objects/ subdirectory, which is shared by every
+# file in the syncdir.
+#
+# The snapshots for each file are listed, one JSON object per line, in
+# a <basename>.HISTORY log next to its other sync state.  Snapshots of
+# the download and the local copy are recorded concurrently, so every
+# change to a log (and gc, which reads them all) is made holding a
+# syncdir-wide HISTORY.LOCK.
+#
+# Files are read a line at a time, so recording a snapshot never holds
+# more than one chunk in memory.  Objects no longer referenced by any
+# log are removed by gc, which scans the whole syncdir; it runs at most
+# once every GC_INTERVAL_SECONDS after a sync, or on demand with
+# "csvsync history --gc".
+
+from .lib import CLIError, FileLock
+
+import os
+import json
+import gzip
+import glob
+import time
+import hashlib
+import logging
+import datetime
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Chunk boundaries: a chunk ends after any line whose hash matches
+# CHUNK_MASK, giving an average chunk of roughly CHUNK_MASK+1 lines,
+# or once a chunk grows beyond CHUNK_MAX_BYTES.
+CHUNK_MASK = 0xff
+CHUNK_MAX_BYTES = 4 * 1024 * 1024
+
+# Unreferenced objects younger than this are never garbage collected,
+# as another sync may be about to record a snapshot using them.
+GC_GRACE_SECONDS = 3600
+
+# How often maybe_gc() actually collects garbage
+GC_INTERVAL_SECONDS = 24 * 3600
+
+class History:
+    def __init__(self, subdir, basename, keep = 20, compression = 'auto'):
+        self.subdir = subdir
+        self.objects_dir = os.path.join(subdir, 'objects')
+        self.log_filename = os.path.join(subdir, basename + '.HISTORY')
+        self.lock_filename = os.path.join(subdir, 'HISTORY.LOCK')
+        self.gc_filename = os.path.join(subdir, 'HISTORY.GC')
+        self.keep = keep
+
+        if compression == 'auto':
+            compression = 'zstd' if zstandard else 'gzip'
+        if compression == 'zstd' and not zstandard:
+            raise CLIError('zstd history compression requested, '
+                           'but the zstandard module is not installed')
+        if compression not in ('zstd', 'gzip'):
+            raise CLIError(f'Unknown history compression "{compression}"')
+        self.compression = compression
+
+    ##
+    ## Object store
+    ##
+
+    def object_path(self, digest, compression):
+        extension = '.zst' if compression == 'zstd' else '.gz'
+        return os.path.join(self.objects_dir, digest[:2], digest[2:] + extension)
+
+    def find_object(self, digest):
+        for compression in ('zstd', 'gzip'):
+            path = self.object_path(digest, compression)
+            if os.path.exists(path):
+                return path, compression
+        return None, None
+
+    def store_object(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+
+        path, compression = self.find_object(digest)
+        if path:
+            # Refresh the mtime so that a concurrent gc leaves it alone
+            os.utime(path)
+            return digest, 0
+
+        if self.compression == 'zstd':
+            compressed = zstandard.ZstdCompressor().compress(data)
+        else:
+            compressed = gzip.compress(data)
+
+        path = self.object_path(digest, self.compression)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp_path = tmp_filename(path)
+        with open(tmp_path, 'wb') as file:
+            file.write(compressed)
+        os.replace(tmp_path, path)
+
+        return digest, len(compressed)
+
+    def load_object(self, digest):
+        path, compression = self.find_object(digest)
+        if not path:
+            raise CLIError(f'History object {digest} is missing')
+
+        with open(path, 'rb') as file:
+            compressed = file.read()
+
+        if compression == 'zstd':
+            if not zstandard:
+                raise CLIError('History object is zstd compressed, '
+                               'but the zstandard module is not installed')
+            return zstandard.ZstdDecompressor().decompress(compressed)
+        return gzip.decompress(compressed)
+
+    ##
+    ## Snapshots
+    ##
+
+    def entries(self):
+        if not os.path.exists(self.log_filename):
+            return []
+        with open(self.log_filename, 'rt') as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def write_entries(self, entries):
+        log_tmp_filename = tmp_filename(self.log_filename)
+        with open(log_tmp_filename, 'wt') as file:
+            for entry in entries:
+                file.write(json.dumps(entry) + '\n')
+        os.replace(log_tmp_filename, self.log_filename)
+
+    def locked(self):
+        os.makedirs(self.subdir, exist_ok = True)
+        return FileLock(self.lock_filename)
+
+    def record(self, kind, filename):
+        """Record the contents of filename as a new snapshot of the given kind"""
+
+        # A first pass hashes the file, so that an unchanged file is
+        # never split into chunks at all
+        digest, size = file_digest(filename)
+
+        with self.locked():
+            entries = self.entries()
+
+            # Nothing to do if this is the same as the last snapshot of this kind
+            previous = [entry for entry in entries if entry['kind'] == kind]
+            if previous and previous[-1]['sha256'] == digest:
+                logging.debug(f"History: {kind} unchanged since snapshot {previous[-1]['id']}")
+                return previous[-1]
+
+            chunks = []
+            stored = 0
+            with open(filename, 'rb') as file:
+                for chunk in split_chunks(file):
+                    chunk_digest, chunk_stored = self.store_object(chunk)
+                    chunks.append(chunk_digest)
+                    stored += chunk_stored
+
+            entry = {'id': entries[-1]['id'] + 1 if entries else 1,
+                     'kind': kind,
+                     'time': datetime.datetime.now().isoformat(timespec = 'seconds'),
+                     'size': size,
+                     'sha256': digest,
+                     'chunks': chunks}
+            entries.append(entry)
+            logging.debug(f"History: recorded {kind} snapshot {entry['id']} of "
+                          f"{size} bytes in {len(chunks)} chunks, {stored} new bytes stored")
+
+            self.write_entries(self.prune(entries))
+            return entry
+
+    def prune(self, entries):
+        # Keep only the most recent snapshots of each kind.  Called
+        # from record, with the lock held.
+        if self.keep <= 0:
+            return entries
+
+        kept = []
+        counts = {}
+        for entry in reversed(entries):
+            counts[entry['kind']] = counts.get(entry['kind'], 0) + 1
+            if counts[entry['kind']] <= self.keep:
+                kept.append(entry)
+
+        if len(kept) < len(entries):
+            logging.debug(f"History: pruned {len(entries) - len(kept)} snapshots")
+        return list(reversed(kept))
+
+    def find(self, snapshot_id):
+        for entry in self.entries():
+            if entry['id'] == snapshot_id:
+                return entry
+        raise CLIError(f'No snapshot {snapshot_id} in history')
+
+    def restore(self, snapshot_id, filename):
+        entry = self.find(snapshot_id)
+
+        digest = hashlib.sha256()
+        restore_tmp_filename = tmp_filename(filename)
+        with open(restore_tmp_filename, 'wb') as file:
+            for chunk_digest in entry['chunks']:
+                chunk = self.load_object(chunk_digest)
+                digest.update(chunk)
+                file.write(chunk)
+
+        if digest.hexdigest() != entry['sha256']:
+            os.unlink(restore_tmp_filename)
+            raise CLIError(f'Snapshot {snapshot_id} is corrupt')
+
+        os.replace(restore_tmp_filename, filename)
+        return entry
+
+    def gc(self):
+        """Remove objects no longer referenced by any file's history"""
+
+        with self.locked():
+            removed = self.gc_objects()
+            with open(self.gc_filename, 'w'):
+                pass
+            return removed
+
+    def maybe_gc(self):
+        """Run gc if it hasn't run in the last GC_INTERVAL_SECONDS"""
+
+        # Only the mtime of HISTORY.GC is checked here, without the
+        # lock, so that parallel syncs don't queue up behind each other
+        # waiting to do the same scan.
+        try:
+            if os.path.getmtime(self.gc_filename) > time.time() - GC_INTERVAL_SECONDS:
+                return 0
+        except FileNotFoundError:
+            pass
+
+        return self.gc()
+
+    def gc_objects(self):
+        referenced = set()
+        for log_filename in glob.glob(os.path.join(self.subdir, '*.HISTORY')):
+            with open(log_filename, 'rt') as file:
+                for line in file:
+                    if line.strip():
+                        referenced.update(json.loads(line)['chunks'])
+
+        removed = 0
+        cutoff = time.time() - GC_GRACE_SECONDS
+        for path in glob.glob(os.path.join(self.objects_dir, '*', '*')):
+            prefix = os.path.basename(os.path.dirname(path))
+            digest = prefix + os.path.basename(path).split('.')[0]
+            if digest not in referenced and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                removed += 1
+
+        logging.debug(f"History: gc removed {removed} objects")
+        return removed
+
+def tmp_filename(filename):
+    # Unique to this process and thread, as several may be writing
+    # the same file at once
+    return f"{filename}.tmp{os.getpid()}.{threading.get_ident()}"
+
+def file_digest(filename):
+    # SHA-256 and size of a file, read a block at a time
+    digest = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+def split_chunks(lines):
+    """
+    Split lines (e.g. a file opened in binary mode) into chunks of
+    whole lines at content-defined boundaries
+    """
+
+    chunk = []
+    chunk_bytes = 0
+    for line in lines:
+        chunk.append(line)
+        chunk_bytes += len(line)
+
+        boundary = hashlib.blake2b(line, digest_size = 4).digest()
+        if int.from_bytes(boundary, 'little') & CHUNK_MASK == 0 or \
+           chunk_bytes >= CHUNK_MAX_BYTES:
+            yield b''.join(chunk)
+            chunk = []
+            chunk_bytes = 0
+
+    if chunk:
+        yield b''.join(chunk)
@@ -1,5 +1,8 @@
 import sys
 import os
+import hashlib
+import fcntl
+import time
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -8,6 +11,75 @@ def format_cli_info(message, level = "Info"):
     progname = os.path.basename(sys.argv[0])
     return f"{progname}: {level} - {message}"
 
+def file_fingerprint(filename):
+    """Return a SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class LockTimeout(Exception):
+    """Raised when a FileLock cannot be acquired in time"""
+
+class FileLock:
+    """
+    Advisory flock()-based lock on a lock file.
+
+    A timeout of None waits for as long as it takes, 0 fails
+    immediately if the lock is held elsewhere, and any other value is
+    a maximum wait in seconds.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, filename, timeout = None):
+        self.filename = filename
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            if self.timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            raise LockTimeout(f"Timed out waiting for lock {self.filename}")
+                        time.sleep(self.POLL_INTERVAL)
+        except:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def atomic_write(filename, data, mode = 'wb'):
+    """Write a file via a temporary file and rename, so readers never see a partial file"""
+    tmp_filename = f"{filename}.tmp{os.getpid()}"
+    with open(tmp_filename, mode) as file:
+        file.write(data)
+    os.replace(tmp_filename, filename)
+
 class CLIError(Exception):
     """Exception class for general sync CLI errors"""
 
@@ -17,3 +89,6 @@ class CLIError(Exception):
 
         super(CLIError, self).__init__(message, *args)
 
+
+class SyncError(CLIError):
+    """Exception class for errors in a sync operation"""
@@ -0,0 +1,253 @@
+# Local backend: sheet tabs held in SQLite files in a directory.
+#
+# Each "spreadsheet" is a SQLite file <local_dir>/<spreadsheet_id>.db
+# holding any number of named tabs, each stored as rows of cells.  It
+# behaves just as the Google Sheets backend does: configured ranges,
+# trailing empty cells and version stamps are all handled the same
+# way, and each upload is applied atomically, together with its
+# version stamp.  But it runs at local disk speed with no network, for
+# load testing, staging mirrors and benchmarks.
+#
+# Every change to a tab takes the next value of a per-database change
+# counter, which the local changes feed uses to find changed tabs, and
+# which serves as the tab's revision.  Triggers advance the counter for
+# any change to a tab's rows, so edits made to the database by hand
+# (eg. with the sqlite3 shell) are noticed just like uploads.
+
+from . import changes
+from .grid import GridBackend, grid_to_a1
+from .lib import eprint, CLIError
+from .table import Table
+
+import os
+import glob
+import json
+import sqlite3
+import logging
+import contextlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tabs (
+    name     TEXT PRIMARY KEY,
+    version  TEXT,
+    seq      INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+    tab      TEXT NOT NULL,
+    rownum   INTEGER NOT NULL,
+    data     TEXT NOT NULL,
+    PRIMARY KEY (tab, rownum)
+);
+CREATE TRIGGER IF NOT EXISTS rows_insert AFTER INSERT ON rows BEGIN
+    UPDATE tabs SET seq = (SELECT MAX(seq) + 1 FROM tabs) WHERE name = NEW.tab;
+END;
+CREATE TRIGGER IF NOT EXISTS rows_update AFTER UPDATE ON rows BEGIN
+    UPDATE tabs SET seq = (SELECT MAX(seq) + 1 FROM tabs) WHERE name IN (OLD.tab, NEW.tab);
+END;
+CREATE TRIGGER IF NOT EXISTS rows_delete AFTER DELETE ON rows BEGIN
+    UPDATE tabs SET seq = (SELECT MAX(seq) + 1 FROM tabs) WHERE name = OLD.tab;
+END;
+"""
+
+def local_dir(fileconfig):
+    return fileconfig.config.file_relative_to_config(fileconfig['local_dir'])
+
+@contextlib.contextmanager
+def connect(filename):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+    db = sqlite3.connect(filename)
+    try:
+        db.executescript(SCHEMA)
+        with db:
+            yield db
+    finally:
+        db.close()
+
+def trim(cells):
+    cells = list(cells)
+    while cells and cells[-1] == '':
+        cells.pop()
+    return cells
+
+def trim_rows(rows):
+    # Trim every row, then drop trailing empty rows
+    rows = [trim(row) for row in rows]
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+class LocalSheet(GridBackend):
+    def __init__(self, fileconfig):
+        self.fileconfig = fileconfig
+        self.spreadsheet_id = fileconfig['spreadsheet_id']
+        self.sheet_name = fileconfig['sheet']
+        self.filename = os.path.join(local_dir(fileconfig), self.spreadsheet_id + '.db')
+
+        # Row checksums only save network reads, so a local tab never
+        # needs a hash column
+        self.ranges = self.configured_ranges()
+
+        with connect(self.filename) as db:
+            self.row_count = db.execute("SELECT COALESCE(MAX(rownum) + 1, 0) FROM rows "
+                                        "WHERE tab = ?", (self.sheet_name,)).fetchone()[0]
+
+        print (f'Found sheet "{self.sheet_name}" in {self.filename}')
+
+    @classmethod
+    def changes_feed(cls, config, fileconfig):
+        return LocalChangesFeed(config, fileconfig)
+
+    def read_version(self):
+        with connect(self.filename) as db:
+            result = db.execute("SELECT version FROM tabs WHERE name = ?",
+                                (self.sheet_name,)).fetchone()
+        return result[0] if result else None
+
+    def read_revision(self):
+        with connect(self.filename) as db:
+            result = db.execute("SELECT seq FROM tabs WHERE name = ?",
+                                (self.sheet_name,)).fetchone()
+        return f"local:{result[0]}" if result else None
+
+    def read_rows(self, db):
+        rows = []
+        for rownum, data in db.execute("SELECT rownum, data FROM rows WHERE tab = ? "
+                                       "ORDER BY rownum", (self.sheet_name,)):
+            rows += [[] for n in range(rownum - len(rows))]
+            rows.append(json.loads(data))
+        return rows
+
+    def write_rows(self, db, rows, touched, version):
+        # Store the touched rows and the version stamp, and mark the tab
+        # as changed
+        updates = [(self.sheet_name, n, json.dumps(trim(rows[n])))
+                   for n in sorted(touched) if n < len(rows) and trim(rows[n])]
+        db.executemany("DELETE FROM rows WHERE tab = ? AND rownum = ?",
+                       [(self.sheet_name, n) for n in touched])
+        db.executemany("INSERT INTO rows (tab, rownum, data) VALUES (?, ?, ?)", updates)
+
+        seq = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM tabs").fetchone()[0]
+        db.execute("INSERT INTO tabs (name, version, seq) VALUES (?, ?, ?) "
+                   "ON CONFLICT (name) DO UPDATE SET seq = excluded.seq, "
+                   "version = COALESCE(excluded.version, version)",
+                   (self.sheet_name, version or None, seq))
+        logging.debug(f"LOCAL: wrote {len(updates)} rows of {self.sheet_name} "
+                      f"in {self.filename}, change {seq}")
+
+    def range_values(self, rows, grid):
+        # The values of a range, as the values API returns them:
+        # trailing empty cells and rows are dropped
+        end = grid.get('endRowIndex', len(rows))
+        return trim_rows([row[grid['startColumnIndex']:grid['endColumnIndex']]
+                          for row in rows[grid['startRowIndex']:end]])
+
+    def save_to_csv(self, filename, pad_lines = True, base_filename = None):
+        with connect(self.filename) as db:
+            rows = self.read_rows(db)
+
+        if self.ranges is None:
+            table = Table.from_rows(trim_rows(rows))
+        else:
+            table = Table().extend(self.stitch_ranges([self.range_values(rows, grid)
+                                                       for grid in self.ranges]))
+
+        print (f'Loaded {len(table)} lines from sheet')
+
+        options = self.fileconfig.csv_options()
+        with open(filename, 'wt') as csvfile:
+            table.write_csv(csvfile, options.csv_kwargs(), pad_lines)
+
+    def set_cells(self, rows, touched, rownum, grid, cells):
+        # Write the cells of one row of a range.  Without any column
+        # bounds the whole row is replaced, as with the sheet.
+        rows += [[] for n in range(rownum + 1 - len(rows))]
+        if 'endColumnIndex' in grid:
+            start, end = grid['startColumnIndex'], grid['endColumnIndex']
+            row = rows[rownum] + [''] * (end - len(rows[rownum]))
+            row[start:end] = list(cells) + [''] * (end - start - len(cells))
+            rows[rownum] = row
+        else:
+            rows[rownum] = list(cells)
+        touched.add(rownum)
+
+    def ranges_and_spans(self):
+        if self.ranges is None:
+            return [({'startRowIndex': 0}, (0, None))]
+        return list(zip(self.ranges, self.column_spans()))
+
+    def load_from_csv(self, filename, version = None):
+        table = Table.from_csv(filename)
+        self.check_width(table)
+        nrows = len(table)
+
+        for grid in self.ranges or []:
+            if 'endRowIndex' in grid and \
+               nrows > grid['endRowIndex'] - grid['startRowIndex']:
+                raise CLIError(f'{nrows} lines will not fit in '
+                               f'configured range {grid_to_a1(grid)}')
+
+        eprint (f'Uploading {nrows} lines...')
+
+        with connect(self.filename) as db:
+            rows = self.read_rows(db)
+            touched = set()
+            for grid, (offset, width) in self.ranges_and_spans():
+                # As with the sheet, lines beyond the new data are
+                # cleared to the end of the range
+                start = grid['startRowIndex']
+                end = grid.get('endRowIndex', max(len(rows), start + nrows))
+                for rownum in range(start, end):
+                    n = rownum - start
+                    cells = table.row(n, offset, None if width is None else offset + width) \
+                        if n < nrows else []
+                    self.set_cells(rows, touched, rownum, grid, cells)
+            self.write_rows(db, rows, touched, version)
+
+    def load_windows(self, windows, total_rows, clear_from = None, retries = 0,
+                     version = None):
+        eprint (f'Uploading {sum([len(rows) for first, rows in windows])} '
+                f'changed lines in {len(windows)} windows...')
+
+        with connect(self.filename) as db:
+            rows = self.read_rows(db)
+            touched = set()
+            for grid, (offset, width) in self.ranges_and_spans():
+                start = grid['startRowIndex']
+                for first, window in windows:
+                    table = Table.from_rows(window)
+                    self.check_width(table, first)
+                    for n in range(len(table)):
+                        cells = table.row(n, offset, None if width is None else offset + width)
+                        self.set_cells(rows, touched, start + first + n, grid, cells)
+
+                if clear_from is not None:
+                    for rownum in range(start + total_rows, start + clear_from):
+                        self.set_cells(rows, touched, rownum, grid, [])
+            self.write_rows(db, rows, touched, version)
+
+class LocalChangesFeed(changes.ChangesFeed):
+    """
+    Changes feed over the local backend's databases.  The token records
+    the change counter of each database at the last poll.
+    """
+
+    STATE_NAME = 'LOCALCHANGES'
+
+    def poll(self):
+        state = self.load()
+        token = state['token']
+
+        current = {}
+        for filename in glob.glob(os.path.join(glob.escape(local_dir(self.fileconfig)), '*.db')):
+            with connect(filename) as db:
+                seq = db.execute("SELECT COALESCE(MAX(seq), 0) FROM tabs").fetchone()[0]
+            current[os.path.basename(filename)[:-len('.db')]] = seq
+
+        if token is None:
+            return None, current
+
+        changed = set(state['pending'])
+        changed.update([spreadsheet_id for spreadsheet_id, seq in current.items()
+                        if token.get(spreadsheet_id) != seq])
+        logging.debug(f"LOCALCHANGES: {len(changed)} files changed")
+        return changed, current
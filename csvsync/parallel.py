@@ -0,0 +1,124 @@
+# Parallel CSV parsing and serialization for very large files.
+#
+# Parsing splits the input file into chunks at record boundaries and
+# parses each chunk on a process pool.  A boundary is a newline at
+# which an even number of quote characters has been seen, so newlines
+# embedded in quoted fields never split a record.  Each worker applies
+# a caller-supplied function to its parsed rows, so the (large) rows
+# themselves never need to be sent back to the parent.
+#
+# Serialization formats slices of rows to CSV text on the pool, and
+# the parent writes the pieces out in order.  Since every worker uses
+# the same csv.writer settings as a single sequential writer would,
+# the output is byte-for-byte identical.
+
+import io
+import os
+import csv
+import logging
+import collections
+import concurrent.futures
+
+BLOCK_SIZE = 1024 * 1024
+
+def record_boundaries(filename, chunk_bytes):
+    """
+    Return a list of (start, end) byte ranges covering the file, each
+    roughly chunk_bytes long and ending on a record boundary.
+    """
+    size = os.path.getsize(filename)
+    chunks = []
+    start = 0
+    target = chunk_bytes
+
+    with open(filename, 'rb') as file:
+        offset = 0
+        quotes = 0
+        while target < size:
+            block = file.read(BLOCK_SIZE)
+            if not block:
+                break
+
+            block_end = offset + len(block)
+            position = max(target - offset, 0)
+            while target < block_end:
+                newline = block.find(b'\n', position)
+                if newline < 0:
+                    break
+                # Quote parity at this newline decides if it ends a record
+                if (quotes + block.count(b'"', 0, newline)) % 2 == 0:
+                    chunks.append((start, offset + newline + 1))
+                    start = offset + newline + 1
+                    target = start + chunk_bytes
+                    position = max(target - offset, newline + 1)
+                else:
+                    position = newline + 1
+
+            quotes += block.count(b'"')
+            offset = block_end
+
+    if start < size:
+        chunks.append((start, size))
+    return chunks
+
+def read_chunk(filename, start, end):
+    """Parse the CSV rows in a byte range of a file"""
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+
+    # Decode just as open(filename, 'rt') would
+    text = io.TextIOWrapper(io.BytesIO(data))
+    return list(csv.reader(text))
+
+def parse_chunk(filename, start, end, func, args):
+    return func(read_chunk(filename, start, end), *args)
+
+def map_csv_chunks(filename, func, args = (), workers = None, chunk_bytes = None):
+    """
+    Parse a CSV file in parallel, returning [func(rows, *args), ...]
+    for each chunk of the file in order.  func must be a module-level
+    function so that it can be sent to the worker processes.
+    """
+    workers = workers or os.cpu_count()
+    if chunk_bytes is None:
+        chunk_bytes = max(os.path.getsize(filename) // (workers * 4), BLOCK_SIZE)
+
+    chunks = record_boundaries(filename, chunk_bytes)
+    logging.debug(f"Parsing {filename} in {len(chunks)} chunks on {workers} workers")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(parse_chunk, filename, start, end, func, args)
+                   for start, end in chunks]
+        return [future.result() for future in futures]
+
+def format_rows(rows, csv_kwargs, pad_to = None):
+    output = io.StringIO()
+    writer = csv.writer(output, **csv_kwargs)
+    for row in rows:
+        if pad_to is not None:
+            row = row + [''] * (pad_to - len(row))
+        writer.writerow(row)
+    return output.getvalue()
+
+def write_rows(csvfile, rows, csv_kwargs, pad_to = None, workers = None, chunk_rows = 50000):
+    """
+    Write rows to an open text file as CSV, formatting slices of rows
+    on a process pool.  If pad_to is given, rows are padded with empty
+    cells to that length.
+    """
+    workers = workers or os.cpu_count()
+    logging.debug(f"Writing {len(rows)} rows in chunks of {chunk_rows} on {workers} workers")
+
+    # Slices are taken as they are submitted, with a bounded number in
+    # flight, so rows held in a compact Table are only decoded a few
+    # slices at a time
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        pending = collections.deque()
+        for start in range(0, len(rows), chunk_rows):
+            pending.append(pool.submit(format_rows, rows[start:start + chunk_rows],
+                                       csv_kwargs, pad_to))
+            if len(pending) >= workers * 2:
+                csvfile.write(pending.popleft().result())
+        while pending:
+            csvfile.write(pending.popleft().result())
@@ -0,0 +1,175 @@
+# Partitioned merging for very large tables.
+#
+# With "partition_rows" set, a table is split into partitions of that
+# many rows of the latest common ancestor.  Rows of the local and
+# remote copies are assigned to the partition their key belongs to in
+# the ancestor; new keys join the partition of the row before them.
+#
+# Each partition is fingerprinted on each side, and the ancestor's
+# fingerprints are recorded in the sync state.  A partition changed on
+# only one side simply takes that side's rows; only partitions changed
+# on both sides need a 3-way merge, and those merges run in parallel
+# on a process pool.  On upload, only the windows of rows that differ
+# from the downloaded remote copy are sent.
+#
+# If any partition merge conflicts, or the headers differ, we return
+# None and the caller falls back to an ordinary whole-file merge, so
+# that conflicts are presented exactly as usual.
+
+from . import diff
+from .lib import file_fingerprint
+
+import io
+import csv
+import json
+import hashlib
+import logging
+import concurrent.futures
+
+import csvdiff3
+
+class PartitionPlan:
+    """The result of a partitioned merge, and the upload needed for it"""
+
+    def __init__(self, nrows, windows, clear_from, fingerprints, merged):
+        self.nrows = nrows
+        self.windows = windows
+        self.clear_from = clear_from
+        self.fingerprints = fingerprints
+        self.merged = merged
+
+def fingerprint(rows):
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(diff.row_hash(row).encode())
+    return digest.hexdigest()
+
+def assign(rows, index, partition_of, count):
+    partitions = [[] for n in range(count)]
+    current = 0
+    for row in rows:
+        current = partition_of.get(diff.row_key(row, index), current)
+        partitions[current].append(row)
+    return partitions
+
+def merge_partition(header, base, local, remote, key, csv_kwargs, quote, lineterminator):
+    # Runs in a worker process: 3-way merge one partition's rows
+
+    def to_file(rows):
+        file = io.StringIO()
+        writer = csv.writer(file, **csv_kwargs)
+        writer.writerow(header)
+        writer.writerows(rows)
+        file.seek(0)
+        return file
+
+    output = io.StringIO()
+    conflicts = csvdiff3.merge3.merge3(to_file(base), to_file(local), to_file(remote),
+                                       key, quote = quote,
+                                       lineterminator = lineterminator,
+                                       output = output)
+    if conflicts:
+        return None
+
+    output.seek(0)
+    return list(csv.reader(output))[1:]
+
+def merge(sync):
+    fileconfig = sync.fileconfig
+    section = fileconfig.section
+    size = section.getint('partition_rows')
+    key = fileconfig['key']
+
+    header, base_rows = diff.read_rows(sync.ancestor_filename)
+    local_header, local_rows = diff.read_rows(sync.local_copy_filename)
+    remote_header, remote_rows = diff.read_rows(sync.download_filename)
+
+    if not header == local_header == remote_header:
+        logging.debug("PARTITION: headers differ, using whole-file merge")
+        return None
+
+    index = diff.key_index(header, key)
+
+    # Partitions are fixed blocks of rows of the ancestor
+    count = max((len(base_rows) + size - 1) // size, 1)
+    partition_of = {diff.row_key(row, index): n // size for n, row in enumerate(base_rows)}
+
+    base = [base_rows[n * size:(n + 1) * size] for n in range(count)]
+    local = assign(local_rows, index, partition_of, count)
+    remote = assign(remote_rows, index, partition_of, count)
+
+    # Use the ancestor fingerprints recorded at the end of the last
+    # sync if they still describe the same partitioning
+    recorded = json.loads(sync.get_state('partitions', 'null') or 'null')
+    if recorded and recorded.get('size') == size and \
+       recorded.get('ancestor') == sync.ancestor_fingerprint and \
+       len(recorded.get('fingerprints', [])) == count:
+        base_fps = recorded['fingerprints']
+    else:
+        base_fps = [fingerprint(rows) for rows in base]
+
+    output = [None] * count
+    to_merge = []
+    for n in range(count):
+        local_fp, remote_fp = fingerprint(local[n]), fingerprint(remote[n])
+        if remote_fp == base_fps[n] or local_fp == remote_fp:
+            output[n] = local[n]
+        elif local_fp == base_fps[n]:
+            output[n] = remote[n]
+        else:
+            to_merge.append(n)
+
+    logging.debug(f"PARTITION: {count} partitions of {size} rows, "
+                  f"{len(to_merge)} changed on both sides")
+
+    if to_merge:
+        csv_kwargs = fileconfig.csv_options().csv_kwargs()
+        workers = section.getint('parallel_workers', 0) or None
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {n: pool.submit(merge_partition, header, base[n], local[n], remote[n],
+                                      key, csv_kwargs, fileconfig['quote'],
+                                      fileconfig['lineterminator'])
+                       for n in to_merge}
+            for n, future in futures.items():
+                output[n] = future.result()
+                if output[n] is None:
+                    logging.debug(f"PARTITION: conflicts in partition {n}, "
+                                  "using whole-file merge")
+                    return None
+
+    # Write out the merged file
+    options = fileconfig.csv_options()
+    with open(sync.merge_filename, 'wt') as csvfile:
+        writer = csv.writer(csvfile, **options.csv_kwargs())
+        writer.writerow(header)
+        for rows in output:
+            writer.writerows(rows)
+
+    # Work out which windows of lines differ from the remote copy.
+    # Line 0 is the header, which never changes here.
+    remote_lines = remote_rows
+    windows = []
+    line = 0
+    for rows in output:
+        if [diff.row_hash(row) for row in rows] != \
+           [diff.row_hash(row) for row in remote_lines[line:line + len(rows)]]:
+            windows.append((line + 1, rows))
+        line += len(rows)
+
+    nrows = line + 1
+    clear_from = len(remote_rows) + 1 if len(remote_rows) > line else None
+
+    # Fingerprint the partitions the merged file will have as the next
+    # ancestor
+    merged_rows = [row for rows in output for row in rows]
+    fingerprints = [fingerprint(merged_rows[n:n + size])
+                    for n in range(0, max(len(merged_rows), 1), size)]
+
+    return PartitionPlan(nrows, windows, clear_from, fingerprints, len(to_merge))
+
+def record(sync, plan):
+    # Record the new ancestor's partition fingerprints in the sync state
+    sync.set_state('partitions', json.dumps({
+        'size': sync.fileconfig.section.getint('partition_rows'),
+        'ancestor': file_fingerprint(sync.ancestor_filename),
+        'fingerprints': plan.fingerprints}))
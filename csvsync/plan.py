@@ -0,0 +1,125 @@
+# Dry-run sync planning.
+#
+# Works out what a sync would do to a file, and what it would cost,
+# without changing the sync state or the remote sheet.  The remote
+# side comes either from a fresh download into a scratch file or, with
+# cached set, from the replica's last known remote snapshot (needing
+# no network access at all).
+
+from . import diff
+from .lib import *
+
+import os
+import json
+import math
+import logging
+
+# Bytes of JSON wrapped around each cell and each row in an upload
+CELL_OVERHEAD = len(json.dumps({'userEnteredValue': {'stringValue': ''}})) + 2
+ROW_OVERHEAD = len(json.dumps({'values': []})) + 2
+
+class Plan:
+    def __init__(self, name, status):
+        self.name = name
+        self.status = status
+
+        # Changes local -> remote (to upload) and remote -> local (to
+        # merge into the local file), as diff.Changes
+        self.to_remote = None
+        self.to_local = None
+
+        # Keys changed differently on both sides
+        self.conflicts = []
+
+        self.upload_requests = 0
+        self.payload_bytes = 0
+        self.duration = 0.0
+
+def hashes_from_file(filename, key):
+    header, rows = diff.read_rows(filename)
+    return header, rows, diff.hash_rows(rows, diff.key_index(header, key))
+
+def payload_size(rows):
+    size = 0
+    for row in rows:
+        size += ROW_OVERHEAD
+        for cell in row:
+            size += CELL_OVERHEAD + len(json.dumps(cell)) - 2
+    return size
+
+def make_plan(sync, cached = False):
+    fileconfig = sync.fileconfig
+    section = fileconfig.section
+    key = fileconfig['key']
+    plan = Plan(fileconfig.section_name, sync.status)
+
+    if not os.path.exists(sync.ancestor_filename):
+        raise SyncError(f"No saved copy ({sync.ancestor_filename}) exists for file")
+    if not os.path.exists(sync.local_filename):
+        raise SyncError(f"Local file ({sync.local_filename}) not found")
+
+    replica = sync.replica
+
+    # Ancestor
+    if replica and replica.exists("base"):
+        base = replica.hashes("base")
+    else:
+        base_header, base_rows, base = hashes_from_file(sync.ancestor_filename, key)
+
+    # Local file.  Its header is kept apart from the others', as the
+    # upload estimate is for local rows, whose columns may differ.
+    local_header, local_rows, local = hashes_from_file(sync.local_filename, key)
+
+    # Remote
+    if cached:
+        if not replica or not replica.exists("remote"):
+            raise SyncError(f"No cached remote copy for file {plan.name}")
+        remote = replica.hashes("remote")
+    else:
+        scratch = os.path.join(sync.subdir, sync.basename + '.PLAN')
+        pad_lines = section.getboolean('pad_lines')
+        try:
+            sync.backend.save_to_csv(scratch, pad_lines)
+            remote_header, remote_rows, remote = hashes_from_file(scratch, key)
+        finally:
+            if os.path.exists(scratch):
+                os.unlink(scratch)
+
+    plan.to_remote = diff.diff_hashes(base, local)
+    plan.to_local = diff.diff_hashes(base, remote)
+
+    remote_changed = set(plan.to_local.added + plan.to_local.removed + plan.to_local.changed)
+    for k in plan.to_remote.added + plan.to_remote.removed + plan.to_remote.changed:
+        if k in remote_changed and local.get(k) != remote.get(k):
+            plan.conflicts.append(k)
+
+    # Upload cost: the whole merged table is uploaded, unless partitioned
+    # merging lets us send only the changed rows
+    if plan.to_remote:
+        size = section.getint('partition_rows')
+        if size > 0:
+            # One request per window of changed rows
+            keys = set(plan.to_remote.added + plan.to_remote.changed)
+            index = diff.key_index(local_header, key)
+            changed = [n for n, row in enumerate(local_rows)
+                       if diff.row_key(row, index) in keys]
+            upload_rows = [local_rows[n] for n in changed]
+            requests = len(set([n // size for n in changed])) + \
+                (1 if plan.to_remote.removed else 0)
+        else:
+            upload_rows = [local_header] + list(local_rows)
+            chunk_rows = section.getint('upload_chunk_rows')
+            if section.getint('upload_concurrency') > 1 and chunk_rows > 0:
+                requests = math.ceil(len(upload_rows) / chunk_rows)
+            else:
+                requests = 1
+
+        plan.upload_requests = requests
+        plan.payload_bytes = payload_size(upload_rows)
+
+        quota = section.getfloat('quota_writes_per_minute')
+        plan.duration = requests * 60.0 / quota if quota > 0 else 0.0
+
+    logging.debug(f"PLAN: {plan.name}: to remote {plan.to_remote.summary()}, "
+                  f"to local {plan.to_local.summary()}, {len(plan.conflicts)} conflicts")
+    return plan
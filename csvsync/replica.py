@@ -0,0 +1,124 @@
+# Local SQLite replica of a synced sheet tab.
+#
+# The replica holds two snapshots of the table, indexed by the
+# configured key column:
+#
+#   "remote": the contents of the remote sheet as of the last download
+#             or upload
+#   "base":   the latest common ancestor, ie. the result of the last
+#             completed sync or pull
+#
+# Snapshots are refreshed incrementally from CSV files: only rows whose
+# hash has changed are rewritten.  Questions about pending local
+# changes can then be answered from the replica without any network
+# access.
+
+from . import diff
+from .lib import CLIError
+
+import sqlite3
+import json
+import logging
+import contextlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    snapshot TEXT PRIMARY KEY,
+    header   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rows (
+    snapshot TEXT NOT NULL,
+    rownum   INTEGER NOT NULL,
+    key      TEXT NOT NULL,
+    hash     TEXT NOT NULL,
+    data     TEXT NOT NULL,
+    PRIMARY KEY (snapshot, rownum)
+);
+CREATE INDEX IF NOT EXISTS rows_key ON rows (snapshot, key);
+"""
+
+class Replica:
+    def __init__(self, filename, key):
+        self.filename = filename
+        self.key = key
+
+    @contextlib.contextmanager
+    def connect(self):
+        # Connections are opened per operation: downloads run in
+        # worker threads, and sqlite connections can't be shared
+        # between threads.
+        db = sqlite3.connect(self.filename)
+        try:
+            db.executescript(SCHEMA)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def refresh(self, snapshot, csv_filename):
+        """Update a snapshot to match the contents of a CSV file"""
+
+        header, rows = diff.read_rows(csv_filename)
+        index = diff.key_index(header, self.key)
+
+        with self.connect() as db:
+            old_hashes = dict(db.execute(
+                "SELECT rownum, hash FROM rows WHERE snapshot = ?", (snapshot,)))
+
+            updates = []
+            for rownum, row in enumerate(rows):
+                row_hash = diff.row_hash(row)
+                if old_hashes.get(rownum) != row_hash:
+                    updates.append((snapshot, rownum, diff.row_key(row, index),
+                                    row_hash, json.dumps(row)))
+
+            db.executemany(
+                "INSERT OR REPLACE INTO rows (snapshot, rownum, key, hash, data) "
+                "VALUES (?, ?, ?, ?, ?)", updates)
+            db.execute("DELETE FROM rows WHERE snapshot = ? AND rownum >= ?",
+                       (snapshot, len(rows)))
+            db.execute("INSERT OR REPLACE INTO meta (snapshot, header) VALUES (?, ?)",
+                       (snapshot, json.dumps(header)))
+
+        logging.debug(f"Replica {snapshot}: {len(updates)} of {len(rows)} rows "
+                      f"updated from {csv_filename}")
+
+    def exists(self, snapshot):
+        with self.connect() as db:
+            return db.execute("SELECT 1 FROM meta WHERE snapshot = ?",
+                              (snapshot,)).fetchone() is not None
+
+    def header(self, snapshot):
+        with self.connect() as db:
+            result = db.execute("SELECT header FROM meta WHERE snapshot = ?",
+                                (snapshot,)).fetchone()
+        if result is None:
+            raise CLIError(f'No {snapshot} replica recorded in {self.filename}')
+        return json.loads(result[0])
+
+    def hashes(self, snapshot):
+        with self.connect() as db:
+            return dict(db.execute(
+                "SELECT key, hash FROM rows WHERE snapshot = ? ORDER BY rownum",
+                (snapshot,)))
+
+    def rows_for_keys(self, snapshot, keys):
+        rows = {}
+        with self.connect() as db:
+            for key in keys:
+                result = db.execute(
+                    "SELECT data FROM rows WHERE snapshot = ? AND key = ?",
+                    (snapshot, key)).fetchone()
+                if result is not None:
+                    rows[key] = json.loads(result[0])
+        return rows
+
+    def diff_file(self, snapshot, csv_filename):
+        """
+        Compare a CSV file against a snapshot, returning the Changes
+        needed to turn the snapshot into the file.
+        """
+        self.header(snapshot)
+        header, rows = diff.read_rows(csv_filename)
+        index = diff.key_index(header, self.key)
+        return diff.diff_hashes(self.hashes(snapshot), diff.hash_rows(rows, index))
@@ -4,14 +4,15 @@
 # the main state machine support, plus various file upload/download utility
 # functions.
 
-from . import gsheet, config
+from . import backend, aio, replica, history, conflicts, statedb
 from .lib import *
 
 import os
-import configparser
 import shutil
 import filecmp
 import logging
+import asyncio
+import contextlib
 
 import csvdiff3
 
@@ -40,20 +41,26 @@ class Sync:
         self.check_config_key('sheet')
         self.check_config_key('key')
 
-        self.__gsheet = None
+        self.__backend = None
+
+        # Set by a partitioned merge, describing the upload it needs
+        self.partition_plan = None
 
         self.subdir = fileconfig.config.file_relative_to_config(fileconfig['syncdir'])
         self.local_filename = fileconfig.config.file_relative_to_config(self.fileconfig['filename'])
 
         basename = fileconfig.section.get('cachename', os.path.basename(fileconfig['filename']))
+        self.basename = basename
 
         # We will maintain persistent state for the 3-way sync in
         # various files in the csvsync/ subdir:
         #
 
-        # An overall status file (to allow us to detect if there is
-        # eg. a pending conflict resolution in progress)
-        self.status_filename = os.path.join(self.subdir, basename + '.STATUS')
+        # The overall status (to allow us to detect if there is eg. a
+        # pending conflict resolution in progress) and other persistent
+        # state live in a database shared by every file in the syncdir
+        self.state_filename = os.path.join(self.subdir, 'STATE')
+        self.statedb = statedb.StateDB(self.state_filename)
 
         # Temporary local download file for the google sheet
         self.download_filename = os.path.join(self.subdir, basename + '.DOWNLOAD')
@@ -65,9 +72,12 @@ class Sync:
         # The "local" copy here can be used to undo the merge and restore to the original contents.
         self.local_copy_filename = os.path.join(self.subdir, basename + '.LOCAL')
 
-        # The download and local file copies above are left in place after a merge/resolve
-        # completes, and can be considered backups of the old copies of the local and
-        # remote contents.
+        # With history enabled (the default) the download and local file copies above
+        # are recorded as history snapshots, and removed along with the merge output
+        # once a sync completes; "csvsync history" and "csvsync restore" recover them.
+        # With history = false they are left in place after a merge/resolve completes,
+        # and can be considered backups of the old copies of the local and remote
+        # contents.
 
         # Output of the 3-way merge:
         self.merge_filename = os.path.join(self.subdir, basename + '.MERGE')
@@ -76,10 +86,49 @@ class Sync:
         # (ie. latest successful merge)
         self.ancestor_filename = os.path.join(self.subdir, basename + '.SAVE')
 
-        self.status_config = configparser.ConfigParser()
+        # SQLite replica of the remote sheet and of the latest common
+        # ancestor, used to answer diff and status queries locally
+        self.replica_filename = os.path.join(self.subdir, basename + '.REPLICA')
+
+        # Lock file held for the duration of any command that changes
+        # the sync state, so that concurrent csvsync processes can't
+        # interleave operations on the same file
+        self.lock_filename = os.path.join(self.subdir, basename + '.LOCK')
+
+        # Index of the conflicts left by a merge awaiting resolution
+        self.conflicts_filename = os.path.join(self.subdir, basename + '.CONFLICTS')
+
+        self.read_status()
+
+    def read_status(self):
+        # The status is loaded from the state database on first use
+        self.__loaded_status = False
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Take the per-file lock.  The "lock_wait" config sets how many
+        # seconds to wait for another process to finish with the file:
+        # 0 fails immediately, and a negative value waits forever.
 
-        if os.path.exists(self.status_filename):
-            self.status_config.read(self.status_filename)
+        wait = self.fileconfig.section.getfloat('lock_wait')
+        lock = FileLock(self.lock_filename, timeout = None if wait < 0 else wait)
+
+        try:
+            lock.acquire()
+        except LockTimeout:
+            raise CLIError(f"File {self.fileconfig.section_name} is locked "
+                           "by another csvsync process")
+
+        logging.debug(f"Acquired lock {self.lock_filename}")
+
+        try:
+            # Somebody else may have changed the state before we got
+            # the lock
+            self.read_status()
+            yield self
+        finally:
+            lock.release()
+            logging.debug(f"Released lock {self.lock_filename}")
 
     def check_config_key(self, keyname):
         fileconfig = self.fileconfig
@@ -95,15 +144,7 @@ class Sync:
         except AttributeError:
             pass
 
-        try:
-            status = self.status_config['csvsync']['status']
-        except KeyError:
-            status = "NEW"
-
-        try:
-            command = self.status_config['csvsync']['current_command']
-        except KeyError:
-            command = "none"
+        status, command, self.state_values = self.statedb.load(self.basename)
 
         self.__status = status
         self.__command = command
@@ -121,6 +162,7 @@ class Sync:
 
     @status.setter
     def status(self, value):
+        self.__load_status()
         old = self.__status
 
         try:
@@ -131,21 +173,29 @@ class Sync:
             self.__status = value
             logging.debug(f"State {old} -> {self.__status}")
 
-        try:
-            section = self.status_config['csvsync']
-        except KeyError:
-            self.status_config.add_section('csvsync')
-            section = self.status_config['csvsync']
+        self.statedb.set_status(self.basename, self.__status, self.__command)
+
+    # Additional persistent state recorded alongside the status, eg.
+    # fingerprints of the last synced contents.  Values are strings.
+
+    def get_state(self, key, default = None):
+        self.__load_status()
+        return self.state_values.get(key, default)
+
+    def set_state(self, key, value):
+        self.__load_status()
+        self.statedb.set_state(self.basename, key, value)
+        self.state_values[key] = value
 
-        section['status'] = self.__status
-        section['current_command'] = self.__command
-        with open(self.status_filename, 'wt') as configfile:
-            self.status_config.write(configfile)
+    def restore_ready(self):
+        # Back out of a sync or pull which failed before changing the
+        # local file or the remote
+        logging.debug(f"Restoring READY after failure in {self.status}")
+        self.status = ("READY", "none")
 
     def state_change(self, old, new, command = None):
         if self.status != old:
-            eprint("Error, state is %s, expecting %s.  Aborting." % (self.status, old))
-            exit(1)
+            raise SyncError(f"State is {self.status}, expecting {old}.  Aborting.")
 
         if command:
             if command == "none":
@@ -159,16 +209,120 @@ class Sync:
     def download(self):
         filename = self.download_filename
 
-        pad_lines = self.fileconfig['pad_lines']
+        pad_lines = self.fileconfig.section.getboolean('pad_lines')
         eprint("Downloading...")
-        self.gsheet.save_to_csv(filename, pad_lines)
+
+        # Note the remote version stamp and revision before
+        # downloading: if anyone uploads or edits after this point,
+        # the ones we record will be stale and the next push will
+        # notice.
+        self.set_state('remote_version', self.backend.read_version() or '')
+        self.set_state('remote_revision', self.backend.read_revision() or '')
+
+        # With row checksums on the sheet, only rows changed since the
+        # last sync are fetched
+        self.backend.save_to_csv(filename, pad_lines, base_filename = self.ancestor_filename)
+        self.update_replica("remote", "download")
+        self.record_history("download", "download")
+
+    def prepare_merge(self):
+        # Download the remote file and take a copy of the local file
+        # ready for the 3-way merge.  The download (including auth and
+        # sheet metadata lookups) runs in a worker thread, overlapping
+        # with the local file preparation.
+
+        aio.complete(self.async_prepare_merge())
+
+    async def async_prepare_merge(self):
+        await asyncio.gather(aio.run(self.download),
+                             aio.run(self.prepare_local))
+
+    def prepare_local(self):
+        self.copy_file("local", "local_copy")
+        self.record_history("local", "local_copy")
+
+        # Fingerprint the local copy and the ancestor: if they match
+        # there are no local changes, and the merge result is simply
+        # the downloaded remote file.
+
+        self.local_fingerprint = file_fingerprint(self.local_copy_filename)
+        self.ancestor_fingerprint = file_fingerprint(self.ancestor_filename)
+        logging.debug(f"Local fingerprint {self.local_fingerprint}, "
+                      f"ancestor fingerprint {self.ancestor_fingerprint}")
+
+    @property
+    def local_unchanged(self):
+        try:
+            return self.local_fingerprint == self.ancestor_fingerprint
+        except AttributeError:
+            return False
 
     def upload(self):
         filename = self.ancestor_filename
         assert os.path.exists(filename)
 
         eprint("Uploading result...")
-        self.gsheet.load_from_csv(filename)
+        version = self.next_version()
+        self.backend.load_from_csv(filename, version)
+        self.set_state('version', version)
+        self.record_revision()
+        self.update_replica("remote", "ancestor")
+
+    # Version stamps are "<counter>:<content hash>".  The stamp of the
+    # last sync is kept in the state as "version"; the stamp seen on
+    # the remote at the last download as "remote_version".
+    #
+    # A stamp only changes when csvsync uploads, so the backend's
+    # revision, which changes with any edit, is kept alongside it in
+    # the same way, as "revision" and "remote_revision".
+
+    def next_version(self):
+        remote_version = self.get_state('remote_version') or '0:'
+        try:
+            counter = int(remote_version.split(':')[0])
+        except ValueError:
+            counter = 0
+        return f"{counter + 1}:{file_fingerprint(self.ancestor_filename)}"
+
+    def remote_unchanged(self):
+        # True if the remote sheet carries the same version stamp and
+        # revision as our last sync, ie. no other csvsync has uploaded
+        # and nobody has edited it since then.  Without a revision from
+        # the backend we can't tell, so assume it has changed.
+        version = self.get_state('version')
+        remote_version = self.backend.read_version()
+        logging.debug(f"Version: last synced {version}, remote {remote_version}")
+        self.set_state('remote_version', remote_version or '')
+        if not version or version != remote_version:
+            return False
+
+        revision = self.get_state('revision')
+        remote_revision = self.backend.read_revision()
+        logging.debug(f"Revision: last synced {revision}, remote {remote_revision}")
+        self.set_state('remote_revision', remote_revision or '')
+        return bool(revision) and revision == remote_revision
+
+    def record_revision(self):
+        # Just uploaded: the remote's revision now describes our
+        # contents.  An edit landing between the upload and this read
+        # would be missed, but the window is a single request wide.
+        self.set_state('revision', self.backend.read_revision() or '')
+
+    def keep_remote_version(self):
+        # Nothing was uploaded, so the remote keeps the stamp and
+        # revision we saw
+        self.set_state('version', self.get_state('remote_version', ''))
+        self.set_state('revision', self.get_state('remote_revision', ''))
+
+    def upload_partitions(self, plan):
+        eprint("Uploading changed partitions...")
+        retries = self.fileconfig.section.getint('partition_retries')
+        version = self.next_version()
+        self.backend.load_windows(plan.windows, plan.nrows, plan.clear_from, retries,
+                                 version = version)
+        self.set_state('version', version)
+        self.record_revision()
+        self.update_replica("remote", "ancestor")
 
     def copy_file(self, file1, file2):
         filename1 = getattr(self, file1 + "_filename")
@@ -177,10 +331,78 @@ class Sync:
         shutil.copy(filename1, filename2)
 
     @property
-    def gsheet(self):
-        if not self.__gsheet:
-            auth = gsheet.Auth(self.fileconfig)
-            self.__gsheet = gsheet.Sheet(self.fileconfig, auth)
+    def replica(self):
+        if not self.fileconfig.section.getboolean('replica'):
+            return None
+        return replica.Replica(self.replica_filename, self.fileconfig['key'])
+
+    def update_replica(self, snapshot, file):
+        if self.replica:
+            self.replica.refresh(snapshot, getattr(self, file + "_filename"))
+
+    def local_changes(self):
+        # Pending local changes, relative to the latest common
+        # ancestor recorded in the replica.  Needs no network access.
+
+        if not self.replica:
+            raise CLIError(f"No replica enabled for file {self.fileconfig.section_name}")
+        if not os.path.exists(self.local_filename):
+            raise CLIError(f"Local file {self.local_filename} not found")
+
+        # Replicas are only built as files are synced; seed the base
+        # snapshot from the saved ancestor if we don't have one yet
+        if not self.replica.exists("base") and os.path.exists(self.ancestor_filename):
+            self.update_replica("base", "ancestor")
+
+        return self.replica.diff_file("base", self.local_filename)
+
+    @property
+    def conflict_index(self):
+        return conflicts.ConflictIndex(self.conflicts_filename, self.local_filename)
+
+    @property
+    def history(self):
+        section = self.fileconfig.section
+        if not section.getboolean('history'):
+            return None
+        return history.History(self.subdir, self.basename,
+                               keep = section.getint('history_keep'),
+                               compression = section['history_compression'])
+
+    def record_history(self, kind, file):
+        if self.history:
+            self.history.record(kind, getattr(self, file + "_filename"))
+
+    def save_ancestor(self):
+        # Record a new latest common ancestor in the replica and history
+        self.update_replica("base", "ancestor")
+        if self.history:
+            self.history.record("ancestor", self.ancestor_filename)
+            self.history.maybe_gc()
+
+    def cleanup(self):
+        # Once a sync has completed, the intermediate files are all
+        # held in the history, so there is no need to keep the plain
+        # copies around.
+
+        if not self.history:
+            return
+
+        for filename in (self.download_filename,
+                         self.local_copy_filename,
+                         self.merge_filename):
+            if os.path.exists(filename):
+                logging.debug(f"Removing {filename}")
+                os.unlink(filename)
+
+    @property
+    def backend(self):
+        # The remote copy of the file, from the configured backend
+        if not self.__backend:
+            self.__backend = backend.open_backend(self.fileconfig)
+
+        return self.__backend
 
-        return self.__gsheet
+    # Older name, from when every file was synced with Google Sheets
+    gsheet = backend
 
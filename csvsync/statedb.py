@@ -0,0 +1,127 @@
+# Syncdir-wide SQLite store of sync state.
+#
+# Every file synced through a syncdir keeps its status, current
+# command and additional state values (fingerprints, version stamps
+# and so on) as rows in a single database in that syncdir, rather than
+# in a .STATUS ini file of its own.  Each change is a single small
+# transaction, and the status of every file can be read in one query.
+#
+# The database runs in WAL mode, so readers (eg. "csvsync status")
+# never block on a sync in progress, and writes from concurrent
+# csvsync processes are serialised by SQLite itself.
+#
+# Existing .STATUS files in the syncdir are migrated into the database
+# the first time it is opened, and renamed out of the way.
+
+import os
+import glob
+import time
+import sqlite3
+import logging
+import contextlib
+import configparser
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name     TEXT PRIMARY KEY,
+    status   TEXT NOT NULL,
+    command  TEXT NOT NULL,
+    updated  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    name     TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    value    TEXT NOT NULL,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key      TEXT PRIMARY KEY,
+    value    TEXT NOT NULL
+);
+"""
+
+# Seconds to wait for another process's write transaction to finish
+BUSY_TIMEOUT = 30
+
+class StateDB:
+    def __init__(self, filename):
+        self.filename = filename
+
+    @contextlib.contextmanager
+    def connect(self):
+        # As with the replica, connections are opened per operation so
+        # that they are never shared between threads
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok = True)
+        db = sqlite3.connect(self.filename, timeout = BUSY_TIMEOUT)
+        try:
+            db.execute("PRAGMA journal_mode = WAL")
+            db.executescript(SCHEMA)
+            self.migrate(db)
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def migrate(self, db):
+        # Import the old per-file .STATUS files, once per syncdir
+        def migrated():
+            return db.execute("SELECT 1 FROM meta WHERE key = 'migrated'").fetchone()
+
+        if migrated():
+            return
+
+        # Take the write lock before checking again, in case another
+        # process is migrating at the same time
+        db.execute("BEGIN IMMEDIATE")
+        with db:
+            if not migrated():
+                self.migrate_status_files(db)
+
+    def migrate_status_files(self, db):
+        subdir = os.path.dirname(self.filename)
+        for status_filename in glob.glob(os.path.join(glob.escape(subdir), '*.STATUS')):
+            name = os.path.basename(status_filename)[:-len('.STATUS')]
+            status_config = configparser.ConfigParser()
+            status_config.read(status_filename)
+            values = dict(status_config['csvsync']) if 'csvsync' in status_config else {}
+            updated = os.path.getmtime(status_filename)
+
+            db.execute("INSERT OR IGNORE INTO files (name, status, command, updated) "
+                       "VALUES (?, ?, ?, ?)",
+                       (name, values.pop('status', 'NEW'),
+                        values.pop('current_command', 'none'), updated))
+            db.executemany("INSERT OR IGNORE INTO state (name, key, value, updated) "
+                           "VALUES (?, ?, ?, ?)",
+                           [(name, key, value, updated) for key, value in values.items()])
+
+            os.replace(status_filename, status_filename + '.MIGRATED')
+            logging.debug(f"Migrated {status_filename} into {self.filename}")
+
+        db.execute("INSERT INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+
+    def load(self, name):
+        """Return the (status, command, {state key: value}) of a file"""
+        with self.connect() as db:
+            result = db.execute("SELECT status, command FROM files WHERE name = ?",
+                                (name,)).fetchone()
+            values = dict(db.execute("SELECT key, value FROM state WHERE name = ?",
+                                     (name,)))
+        status, command = result or ("NEW", "none")
+        return status, command, values
+
+    def set_status(self, name, status, command):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO files (name, status, command, updated) "
+                       "VALUES (?, ?, ?, ?)", (name, status, command, time.time()))
+
+    def set_state(self, name, key, value):
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO state (name, key, value, updated) "
+                       "VALUES (?, ?, ?, ?)", (name, key, value, time.time()))
+
+    def all(self):
+        """Return {name: (status, command, updated)} for every file"""
+        with self.connect() as db:
+            return {name: (status, command, updated) for name, status, command, updated
+                    in db.execute("SELECT name, status, command, updated FROM files")}
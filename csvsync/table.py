@@ -0,0 +1,146 @@
+# Compact in-memory tables.
+#
+# A Table stores a CSV-like table by column.  Every distinct cell
+# value is interned once, and each column is an array of integer codes
+# into that dictionary of values.  Tables with many repeated values
+# (status columns, booleans, dates...) then take a small fraction of
+# the memory of a list of lists of Python strings, and create far
+# fewer objects for the garbage collector to track.
+#
+# Tables are built incrementally, a row at a time, from API pages or
+# CSV readers, and rows are only ever decoded one at a time, as they
+# are written out as CSV, encoded for upload or hashed for diffing.
+
+import csv
+from array import array
+
+# Typecode of the code and width arrays.  'I' is 4 bytes on every
+# platform we run on, half of a list's 8-byte pointer per cell on
+# 64-bit builds (where 'L' would be 8 bytes too), and still allows
+# four billion distinct values.
+CODE_TYPE = 'I'
+
+class Table:
+    def __init__(self):
+        # Code 0 is always the empty string, so that columns can be
+        # extended with empty cells for free
+        self.values = ['']
+        self.codes = {'': 0}
+        self.columns = []
+        self.widths = array(CODE_TYPE)
+
+    def __len__(self):
+        return len(self.widths)
+
+    @property
+    def max_width(self):
+        return max(self.widths, default = 0)
+
+    def code(self, value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+            return code
+
+    def append(self, row):
+        nrows = len(self.widths)
+        while len(self.columns) < len(row):
+            self.columns.append(array(CODE_TYPE, bytes(array(CODE_TYPE).itemsize * nrows)))
+
+        code = self.code
+        for column, value in zip(self.columns, row):
+            column.append(code(value))
+        for column in self.columns[len(row):]:
+            column.append(0)
+        self.widths.append(len(row))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+        return self
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls().extend(rows)
+
+    @classmethod
+    def from_csv(cls, filename):
+        with open(filename, 'rt') as csvfile:
+            return cls().extend(csv.reader(csvfile))
+
+    def extend_table(self, other):
+        """Append all rows of another table"""
+        recode = [self.code(value) for value in other.values]
+        nrows = len(self.widths)
+        while len(self.columns) < len(other.columns):
+            self.columns.append(array(CODE_TYPE, bytes(array(CODE_TYPE).itemsize * nrows)))
+        for n, column in enumerate(self.columns):
+            if n < len(other.columns):
+                column.extend([recode[code] for code in other.columns[n]])
+            else:
+                column.frombytes(bytes(column.itemsize * len(other)))
+        self.widths.extend(other.widths)
+        return self
+
+    def row(self, n, start = 0, stop = None):
+        """Decode row n, optionally just columns [start, stop)"""
+        width = self.widths[n]
+        stop = width if stop is None else min(stop, width)
+        values = self.values
+        return [values[self.columns[c][n]] for c in range(start, stop)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row(n) for n in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.row(index)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.row(n)
+
+    def write_csv(self, csvfile, csv_kwargs, pad = False):
+        writer = csv.writer(csvfile, **csv_kwargs)
+        if pad:
+            max_width = self.max_width
+            for n in range(len(self)):
+                row = self.row(n)
+                writer.writerow(row + [''] * (max_width - len(row)))
+        else:
+            for n in range(len(self)):
+                writer.writerow(self.row(n))
+
+    def first_too_wide(self, width):
+        """Index of the first row with non-empty cells at or beyond width, or None"""
+        for n in range(len(self)):
+            if self.widths[n] > width and \
+               any(self.columns[c][n] for c in range(width, self.widths[n])):
+                return n
+        return None
+
+    def row_data(self, start, stop, col_start = 0, col_stop = None):
+        """
+        Encode rows [start, stop) as API row data for an updateCells
+        request, optionally just columns [col_start, col_stop)
+        """
+        # Every cell is uploaded as a string; encode each distinct
+        # value only once
+        encoded = {}
+        rowdata = []
+        for n in range(start, min(stop, len(self))):
+            width = self.widths[n]
+            end = width if col_stop is None else min(col_stop, width)
+            cells = []
+            for c in range(col_start, end):
+                code = self.columns[c][n]
+                cell = encoded.get(code)
+                if cell is None:
+                    cell = {'userEnteredValue': {'stringValue': self.values[code]}}
+                    encoded[code] = cell
+                cells.append(cell)
+            rowdata.append({'values': cells})
+        return rowdata
@@ -0,0 +1,140 @@
+import re
+import copy
+import types
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from csvsync import config, gsheet
+from csvsync.state import Sync
+
+class Request:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, **kwargs):
+        return copy.deepcopy(self.result)
+
+A1_PATTERN = re.compile(r'^([A-Z]*)([0-9]*)(?::([A-Z]*)([0-9]*))?$')
+
+def parse_range(a1):
+    # (first row, end row, first column, end column) of an A1 range,
+    # which unlike a synced range may be whole rows (eg. "1:500")
+    start_col, start_row, end_col, end_row = A1_PATTERN.match(a1).groups()
+    if end_col is None and end_row is None:
+        end_col, end_row = start_col, start_row
+    return (int(start_row) - 1 if start_row else 0,
+            int(end_row) if end_row else None,
+            gsheet.column_index(start_col) if start_col else 0,
+            gsheet.column_index(end_col) + 1 if end_col else None)
+
+def trim_values(rows):
+    # The values API drops trailing empty cells and rows
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+class FakeValues:
+    def __init__(self, spreadsheets):
+        self.spreadsheets = spreadsheets
+
+    def get(self, spreadsheetId, range, majorDimension = 'ROWS', fields = None):
+        self.spreadsheets.calls.append(('get', [range]))
+        values = self.spreadsheets.range_values(range, majorDimension)
+        return Request({'values': values} if values else {})
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension = 'ROWS', fields = None):
+        self.spreadsheets.calls.append(('batchGet', list(ranges)))
+        value_ranges = []
+        for a1 in ranges:
+            values = self.spreadsheets.range_values(a1, majorDimension)
+            value_ranges.append({'values': values} if values else {})
+        return Request({'valueRanges': value_ranges})
+
+class FakeSpreadsheets:
+    """Just enough of the Sheets API spreadsheets() resource to download a tab"""
+
+    def __init__(self, title, cells, row_count = None):
+        self.title = title
+        self.cells = cells
+        self.row_count = max(len(cells), 100) if row_count is None else row_count
+        self.calls = []
+
+    def get(self, spreadsheetId, fields = None):
+        return Request({'sheets': [{'properties': {
+            'sheetId': 0, 'title': self.title,
+            'gridProperties': {'rowCount': self.row_count}}}]})
+
+    def values(self):
+        return FakeValues(self)
+
+    def range_values(self, a1, major_dimension):
+        name, _, cells_a1 = a1.rpartition('!')
+        assert (name or cells_a1).strip("'") == self.title
+
+        rows = self.cells
+        if name:
+            first_row, end_row, first_column, end_column = parse_range(cells_a1)
+            # As with the real API, reads must stay within the grid
+            if first_row >= self.row_count or (end_row or 0) > self.row_count:
+                raise ValueError(f'Range {a1} exceeds grid limits')
+            rows = [row[first_column:end_column] for row in rows[first_row:end_row]]
+
+        if major_dimension == 'COLUMNS':
+            width = max([len(row) for row in rows], default = 0)
+            rows = [[row[n] if n < len(row) else '' for row in rows] for n in range(width)]
+        return trim_values(rows)
+
+@pytest.fixture
+def make_sheet(tmp_path, monkeypatch):
+    """
+    Return a function creating a gsheet.Sheet over a fake spreadsheet
+    holding the given cells, with a csvsync.ini in tmp_path giving any
+    extra file settings
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gsheet.Sheet, 'execute', lambda self, request: request.execute())
+
+    def make(cells, row_count = None, **settings):
+        settings = dict({'filename': 'test.csv', 'spreadsheet_id': 'test-spreadsheet',
+                         'sheet': 'Sheet1', 'key': 'key'}, **settings)
+        with open(tmp_path / 'csvsync.ini', 'wt') as file:
+            file.write('[test]\n')
+            for name, value in settings.items():
+                file.write(f'{name} = {value}\n')
+
+        service = FakeSpreadsheets('Sheet1', cells, row_count)
+        monkeypatch.setattr(gsheet, 'build', lambda *args, **kwargs:
+                            types.SimpleNamespace(spreadsheets = lambda: service))
+        auth = types.SimpleNamespace(creds = AnonymousCredentials())
+        return gsheet.Sheet(config.Config()['test'], auth), service
+
+    return make
+
+@pytest.fixture
+def make_local_sync(tmp_path, monkeypatch):
+    """
+    Return a function creating a Sync of test.csv, holding the given
+    contents, against the local backend
+    """
+
+    monkeypatch.chdir(tmp_path)
+
+    def make(contents, **settings):
+        settings = dict({'filename': 'test.csv', 'spreadsheet_id': 'local-spreadsheet',
+                         'sheet': 'Sheet1', 'key': 'key', 'backend': 'local'}, **settings)
+        with open(tmp_path / 'csvsync.ini', 'wt') as file:
+            file.write('[test]\n')
+            for name, value in settings.items():
+                file.write(f'{name} = {value}\n')
+        (tmp_path / 'csvsync').mkdir(exist_ok = True)
+        with open(tmp_path / 'test.csv', 'wt') as file:
+            file.write(contents)
+        return Sync(config.Config()['test'])
+
+    return make
@@ -0,0 +1,44 @@
+import csv
+
+from csvsync import gsheet
+from csvsync.gsheet import row_checksum
+
+def test_checksum_distinguishes_rows():
+    # These two rows had equal checksums with the old position-weighted
+    # sums, so an edit from one to the other went unnoticed
+    assert row_checksum(['7', 'widget', '3521'], 3) != row_checksum(['7', 'widget', '4250'], 3)
+    assert row_checksum(['ab', ''], 2) != row_checksum(['a', 'b'], 2)
+    assert row_checksum(['ab'], 1) != row_checksum(['ba'], 1)
+
+def test_checksum_padding():
+    assert row_checksum(['a'], 3) == row_checksum(['a', '', ''], 3)
+    assert row_checksum(['a', 'b', 'c'], 2) == row_checksum(['a', 'b'], 2)
+    assert row_checksum(['', ''], 2) == ''
+    assert row_checksum([], 2) == ''
+
+def test_checksum_exact_in_sheet():
+    # Every intermediate value of the sheet formula must be an exact
+    # integer in a double
+    for base, modulus in gsheet.CHECKSUM_HASHES:
+        assert (modulus - 1) * base + 0x10ffff < 2 ** 53
+        assert f'MOD(h * {base} + x, {modulus})' in gsheet.checksum_formula(['A1:C'])
+
+def test_changed_row_downloaded(make_sheet, tmp_path):
+    base = [['key', 'item', 'qty']] + [[str(n), 'widget', str(n * 100)] for n in range(1, 10)]
+    base[7] = ['7', 'widget', '3521']
+    with open(tmp_path / 'base.csv', 'wt', newline = '') as file:
+        csv.writer(file).writerows(base)
+
+    # Edited by hand on the sheet, which updates its checksum
+    remote = [list(row) for row in base]
+    remote[7][2] = '4250'
+    cells = [row + [row_checksum(row, 3)] for row in remote]
+
+    sheet, service = make_sheet(cells, hash_column = 'D', lineterminator = 'lf')
+    sheet.save_to_csv(str(tmp_path / 'download.csv'), base_filename = str(tmp_path / 'base.csv'))
+
+    with open(tmp_path / 'download.csv', newline = '') as file:
+        assert list(csv.reader(file)) == remote
+
+    # Only the changed row was fetched, after the keys and checksums
+    assert service.calls[-1] == ('batchGet', ["'Sheet1'!A8:C8"])
@@ -0,0 +1,49 @@
+import pytest
+
+from csvsync import api, conflicts
+from csvsync.lib import SyncError
+
+def test_has_markers_inline(tmp_path):
+    filename = tmp_path / 'test.csv'
+    filename.write_text('key,value\n1,"<<<<<<< a ======= b >>>>>>>"\n')
+    assert conflicts.has_markers(str(filename))
+
+    filename.write_text('key,value\n1,a\n')
+    assert not conflicts.has_markers(str(filename))
+
+def test_unlocated_conflict_is_unresolved(tmp_path):
+    def write(name, contents):
+        (tmp_path / name).write_text(contents)
+        return str(tmp_path / name)
+
+    base = write('base.csv', 'key,value\n1,a\n2,b\n')
+    local = write('local.csv', 'key,value\n1,a\n2,local\n')
+    remote = write('remote.csv', 'key,value\n1,a\n2,remote\n')
+    merged = write('merged.csv', 'key,value\n1,a\n')
+
+    index = conflicts.ConflictIndex(str(tmp_path / 'conflicts.json'), merged)
+    index.save(index.build(base, local, remote, 'key', merged))
+    assert index.unresolved() == ['2']
+
+@pytest.fixture
+def resolving(make_local_sync):
+    sync = make_local_sync('key,value\n1,<<<<<<< a ======= b >>>>>>>\n')
+    sync.copy_file("local", "ancestor")
+    sync.status = ("RESOLVE", "sync")
+    return sync
+
+def test_continue_checks_markers_without_index(resolving, monkeypatch):
+    monkeypatch.setattr(api, 'get_sync', lambda config, name: resolving)
+
+    with pytest.raises(SyncError, match = 'markers'):
+        api.sync(None, 'test.csv', continue_sync = True)
+    assert resolving.status == "RESOLVE"
+
+def test_continue_checks_markers_with_empty_index(resolving, monkeypatch):
+    monkeypatch.setattr(api, 'get_sync', lambda config, name: resolving)
+    index = resolving.conflict_index
+    index.save({'header': ['key', 'value'], 'key': 'key', 'conflicts': []})
+
+    with pytest.raises(SyncError, match = 'markers'):
+        api.sync(None, 'test.csv', continue_sync = True)
+    assert resolving.status == "RESOLVE"
@@ -0,0 +1,45 @@
+CELLS = [['key', 'value', '', 'note'],
+         ['1', 'a', '', ''],
+         ['2', '', '', 'x'],
+         [],
+         [],
+         [],
+         ['', '', '', 'y'],
+         ['3', 'b'],
+         [],
+         []]
+
+def test_paged_download(make_sheet, monkeypatch):
+    sheet, service = make_sheet(CELLS, row_count = 11)
+    monkeypatch.setattr(sheet, 'DOWNLOAD_PAGE_ROWS', 3)
+
+    # The same rows as a single values request for the whole tab:
+    # empty rows are kept across page boundaries, but not at the end
+    assert list(sheet.get_all_rows()) == [['key', 'value', '', 'note'],
+                                          ['1', 'a'],
+                                          ['2', '', '', 'x'],
+                                          [], [], [],
+                                          ['', '', '', 'y'],
+                                          ['3', 'b']]
+    assert [ranges for call, ranges in service.calls] == \
+        [["'Sheet1'!1:3"], ["'Sheet1'!4:6"], ["'Sheet1'!7:9"], ["'Sheet1'!10:11"]]
+
+def test_paged_download_ranges(make_sheet, monkeypatch):
+    sheet, service = make_sheet(CELLS, row_count = 10, columns = 'A:B,D2:D9')
+    monkeypatch.setattr(sheet, 'DOWNLOAD_PAGE_ROWS', 2)
+
+    expected = list(sheet.stitch_ranges([service.range_values(sheet.a1_range(grid), 'ROWS')
+                                         for grid in sheet.ranges]))
+    assert list(sheet.get_all_rows()) == expected
+    assert service.calls[1] == ('batchGet', ["'Sheet1'!A3:B4", "'Sheet1'!D4:D5"])
+
+def test_download_small_grid(make_sheet):
+    # A tab smaller than a page is read in one request covering just
+    # its grid, with an open-ended range clamped to the grid too
+    sheet, service = make_sheet(CELLS, row_count = 10)
+    assert list(sheet.get_all_rows())[-1] == ['3', 'b']
+    assert service.calls == [('get', ["'Sheet1'!1:10"])]
+
+    sheet, service = make_sheet(CELLS, row_count = 10, columns = 'A:B')
+    sheet.get_all_rows()
+    assert service.calls == [('batchGet', ["'Sheet1'!A1:B10"])]
@@ -0,0 +1,78 @@
+import http.server
+import threading
+import urllib.parse
+
+import pytest
+
+from csvsync import gsheet
+
+# As the export endpoint sends it: minimally quoted, CRLF line endings,
+# padded to the full width, and with no final line terminator
+EXPORT = b'key,value,note\r\n1,"a\nb",\r\n2,x,y\r\n3,"q""q",'
+
+@pytest.fixture
+def export_server(monkeypatch):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            server.requests.append((url.path, urllib.parse.parse_qs(url.query)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(server.data)))
+            self.end_headers()
+            self.wfile.write(server.data)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    server.data = EXPORT
+    server.requests = []
+    thread = threading.Thread(target = server.serve_forever, daemon = True,
+                              kwargs = {'poll_interval': 0.05})
+    thread.start()
+
+    host, port = server.server_address
+    monkeypatch.setattr(gsheet.Sheet, 'EXPORT_URL',
+                        f'http://{host}:{port}/spreadsheets/d/{{spreadsheet_id}}/export')
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+def download(make_sheet, tmp_path, pad_lines = True, **settings):
+    sheet, service = make_sheet([], export_threshold = 1, **settings)
+    assert sheet.use_export()
+
+    sheet.save_to_csv(str(tmp_path / 'download.csv'), pad_lines)
+    assert not (tmp_path / 'download.csv.EXPORT').exists()
+    assert service.calls == []
+    return (tmp_path / 'download.csv').read_bytes()
+
+def test_export_raw(make_sheet, export_server, tmp_path):
+    # Matching options: the export is streamed to the file as it is,
+    # adding just the missing final line terminator
+    data = download(make_sheet, tmp_path, lineterminator = 'crlf')
+    assert data == EXPORT + b'\r\n'
+    assert export_server.requests == [('/spreadsheets/d/test-spreadsheet/export',
+                                       {'format': ['csv'], 'gid': ['0']})]
+
+def test_export_raw_final_newline(make_sheet, export_server, tmp_path):
+    export_server.data = EXPORT + b'\r\n'
+    data = download(make_sheet, tmp_path, lineterminator = 'crlf')
+    assert data == EXPORT + b'\r\n'
+
+def test_export_requote_lineterminator(make_sheet, export_server, tmp_path):
+    data = download(make_sheet, tmp_path, lineterminator = 'lf')
+    assert data == b'key,value,note\n1,"a\nb",\n2,x,y\n3,"q""q",\n'
+
+def test_export_requote_quoting(make_sheet, export_server, tmp_path):
+    data = download(make_sheet, tmp_path, quote = 'all', lineterminator = 'crlf')
+    assert data == b'"key","value","note"\r\n"1","a\nb",""\r\n' \
+        b'"2","x","y"\r\n"3","q""q",""\r\n'
+
+def test_export_requote_unpadded(make_sheet, export_server, tmp_path):
+    # Without padding, trailing empty cells are dropped as the values
+    # API would
+    data = download(make_sheet, tmp_path, pad_lines = False, lineterminator = 'crlf')
+    assert data == b'key,value,note\r\n1,"a\nb"\r\n2,x,y\r\n3,"q""q"\r\n'
@@ -0,0 +1,33 @@
+import os
+
+from csvsync import history
+
+def test_record_and_restore(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, 'CHUNK_MASK', 0x3)
+    data = b''.join(b'%d,value %d\r\n' % (i, i) for i in range(1000)) + b'last,no newline'
+    filename = tmp_path / 'test.csv'
+    filename.write_bytes(data)
+
+    store = history.History(str(tmp_path / 'sync'), 'test', compression = 'gzip')
+    entry = store.record('local', str(filename))
+    assert entry['size'] == len(data)
+    assert len(entry['chunks']) > 1
+
+    # Unchanged contents aren't recorded again
+    assert store.record('local', str(filename)) == entry
+
+    store.restore(entry['id'], str(tmp_path / 'restored.csv'))
+    assert (tmp_path / 'restored.csv').read_bytes() == data
+
+def test_maybe_gc(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, 'GC_GRACE_SECONDS', -1)
+    store = history.History(str(tmp_path / 'sync'), 'test', compression = 'gzip')
+    os.makedirs(store.subdir)
+
+    store.store_object(b'unreferenced\n')
+    assert store.maybe_gc() == 1
+
+    # Skipped until GC_INTERVAL_SECONDS has passed
+    store.store_object(b'unreferenced\n')
+    assert store.maybe_gc() == 0
+    assert store.gc() == 1
@@ -0,0 +1,16 @@
+from csvsync import plan
+
+def test_plan_local_columns_differ(make_local_sync):
+    # The remote has its columns in a different order from the local
+    # file, so local rows must be read with the local header
+    sync = make_local_sync('key,value\n1,a\n2,b\n3,c\n', partition_rows = 2)
+    with open(sync.ancestor_filename, 'wt') as file:
+        file.write('key,value\n1,a\n2,b\n3,old\n')
+    with open('remote.csv', 'wt') as file:
+        file.write('value,key\na,1\nb,2\nold,3\n')
+    sync.backend.load_from_csv('remote.csv')
+
+    result = plan.make_plan(sync)
+    assert result.to_remote.changed == ['3']
+    assert result.upload_requests == 1
+    assert result.payload_bytes == plan.payload_size([['3', 'c']])
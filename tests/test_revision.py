@@ -0,0 +1,58 @@
+import json
+import sqlite3
+
+import pytest
+
+from csvsync.gsheet import row_checksum
+
+@pytest.fixture
+def sync(make_local_sync):
+    return make_local_sync('key,value\n1,a\n2,b\n')
+
+def edit_by_hand(sync):
+    # As with the sqlite3 shell: no version stamp, no csvsync
+    with sqlite3.connect(sync.backend.filename) as db:
+        db.execute("UPDATE rows SET data = ? WHERE tab = 'Sheet1' AND rownum = 1",
+                   (json.dumps(['1', 'edited']),))
+
+def test_upload_then_hand_edit(sync):
+    sync.copy_file("local", "ancestor")
+    sync.upload()
+    assert sync.remote_unchanged()
+
+    # The version stamp is unchanged, but the revision isn't
+    edit_by_hand(sync)
+    assert sync.get_state('version') == sync.backend.read_version()
+    assert not sync.remote_unchanged()
+
+def test_download_then_upload_without_stamp(sync):
+    sync.backend.load_from_csv(sync.local_filename, '1:seed')
+    sync.download()
+    sync.keep_remote_version()
+    assert sync.remote_unchanged()
+
+    sync.backend.load_from_csv(sync.local_filename)
+    assert not sync.remote_unchanged()
+
+def test_no_revision(sync, monkeypatch):
+    # A backend which can't tell if it was edited never skips a merge
+    monkeypatch.setattr(type(sync.backend), 'read_revision', lambda self: None)
+    sync.copy_file("local", "ancestor")
+    sync.upload()
+    assert not sync.remote_unchanged()
+
+def test_sheet_revision(make_sheet):
+    # Without a Drive token, a sheet's revision comes from its checksums
+    rows = [['key', 'value'], ['1', 'a'], ['2', 'b']]
+    sheet, service = make_sheet([row + ['', row_checksum(row, 2)] for row in rows],
+                                hash_column = 'D')
+    revision = sheet.read_revision()
+    assert revision.startswith('checksums:')
+    assert sheet.read_revision() == revision
+
+    service.cells[1] = ['1', 'edited', '', row_checksum(['1', 'edited'], 2)]
+    assert sheet.read_revision() != revision
+
+    # Nor without checksums
+    sheet, service = make_sheet(rows)
+    assert sheet.read_revision() is None
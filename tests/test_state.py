@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+
+from csvsync import api
+
+@pytest.fixture
+def sync(make_local_sync):
+    sync = make_local_sync('key,value\n1,a\n2,b\n')
+    sync.copy_file("local", "ancestor")
+    sync.upload()
+    sync.status = ("READY", "none")
+    return sync
+
+def fail(*args, **kwargs):
+    raise OSError("network down")
+
+@pytest.mark.parametrize("command", ["sync", "pull"])
+def test_failed_download_restores_ready(sync, monkeypatch, command):
+    monkeypatch.setattr(type(sync.backend), 'save_to_csv', fail)
+    monkeypatch.setattr(api, 'get_sync', lambda config, name: sync)
+
+    with pytest.raises(OSError):
+        if command == "sync":
+            api.sync(None, 'test.csv')
+        else:
+            api.pull(None, 'test.csv', force = True)
+
+    assert sync.status == "READY"
+    assert sync.command == "none"
+
+def test_prepare_merge_in_running_loop(sync):
+    async def prepare():
+        sync.prepare_merge()
+
+    asyncio.run(prepare())
+
+    with open(sync.download_filename) as f:
+        assert f.read() == 'key,value\n1,a\n2,b\n'
+
+def test_sync_many_in_running_loop(sync, monkeypatch):
+    monkeypatch.setattr(api, 'get_sync', lambda config, name: sync)
+
+    async def run():
+        return [api.sync_many(None, ['test.csv']),
+                await api.async_sync_many(None, ['test.csv'])]
+
+    for results in asyncio.run(run()):
+        assert [result.error for result in results] == [None]